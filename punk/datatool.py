@@ -0,0 +1,392 @@
+"""Офлайн-инструмент для rooms.json / users.json: экспорт и импорт NDJSON, компактизация.
+
+Файлы читаются потоково, без json.load целиком: в памяти одновременно одна
+комната без сообщений, одно сообщение или один пользователь. Пути, число копий
+и их ротация берутся из main.py. Запускать при остановленном сервере, из той
+же рабочей директории:
+
+    python datatool.py export -o dump.ndjson --room ABCD --since 2024-01-01 --strip-avatars
+    python datatool.py import dump.ndjson
+    python datatool.py compact --drop-deleted
+
+Строки NDJSON:
+    {"type": "message", "room": код, "message": {...}}
+    {"type": "room", "code": код, "room": {... без messages}}
+    {"type": "user", "id": id, "user": {...}}
+Сообщения комнаты и ее строка room идут подряд; при экспорте room — после
+своих сообщений (в rooms.json last_seq и прочие поля лежат после messages).
+"""
+import os
+import sys
+import json
+import base64
+import argparse
+from datetime import datetime
+
+from main import app, replace_with_backups, SNAPSHOT_BACKUPS
+
+READ_CHUNK = 64 * 1024
+
+# ----- Incremental JSON parser -----
+class JsonStream:
+    """Потоковый разбор JSON: объекты и массивы обходятся по ключам/элементам,
+    а отдельные значения декодируются json.raw_decode из скользящего буфера."""
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self, size=READ_CHUNK):
+        if self.eof:
+            return False
+        if self.pos > READ_CHUNK:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        chunk = self.f.read(size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf += chunk
+        return True
+
+    def _error(self, message):
+        raise ValueError(f"{message} at offset ~{self.f.tell() - len(self.buf) + self.pos}")
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            self._error(f"expected {char!r}")
+        self.pos += 1
+
+    def value(self):
+        """Следующее значение целиком. Если оно обрезано концом буфера,
+        дочитываем, каждый раз удваивая порцию, чтобы большие значения не разбирались квадратично."""
+        self.peek()
+        while True:
+            try:
+                result, end = self.decoder.raw_decode(self.buf, self.pos)
+                # Число на границе буфера могло быть разрезано — дочитываем и проверяем
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return result
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill(max(READ_CHUNK, len(self.buf) - self.pos))
+
+    def _items(self, close):
+        first = True
+        while True:
+            char = self.peek()
+            if char == close:
+                self.pos += 1
+                return
+            if not first:
+                self.expect(',')
+            if not char:
+                self._error("unexpected end of input")
+            first = False
+            yield
+
+    def iter_object(self):
+        """Ключи объекта; значение каждого ключа вызывающий обязан прочитать до следующей итерации"""
+        self.expect('{')
+        for _ in self._items('}'):
+            key = self.value()
+            if not isinstance(key, str):
+                self._error("expected object key")
+            self.expect(':')
+            yield key
+
+    def iter_array(self):
+        """Элементы массива, по одному декодированному значению"""
+        self.expect('[')
+        for _ in self._items(']'):
+            yield self.value()
+
+def iter_rooms(path):
+    """(код, поле, значение) для rooms.json; сообщения отдаются по одному с полем 'message',
+    а в конце комнаты — ('room', заголовок без messages)"""
+    with open(path, "r", encoding="utf-8") as f:
+        stream = JsonStream(f)
+        for code in stream.iter_object():
+            header = {}
+            for key in stream.iter_object():
+                if key == 'messages':
+                    for message in stream.iter_array():
+                        yield code, 'message', message
+                else:
+                    header[key] = stream.value()
+            yield code, 'room', header
+
+def iter_users(path):
+    with open(path, "r", encoding="utf-8") as f:
+        stream = JsonStream(f)
+        for user_id in stream.iter_object():
+            yield user_id, stream.value()
+
+# ----- Streaming writers -----
+def dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+class ObjectWriter:
+    """Пишет JSON-объект верхнего уровня по одному ключу во временный файл;
+    commit() делает fsync и подменяет файл через replace_with_backups из main.py"""
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.f = open(self.tmp_path, "w", encoding="utf-8")
+        self.f.write('{')
+        self.count = 0
+
+    def key(self, key):
+        self.f.write((',' if self.count else '') + dumps(key) + ':')
+        self.count += 1
+
+    def item(self, key, value):
+        self.key(key)
+        self.f.write(dumps(value))
+
+    def commit(self):
+        self.f.write('}')
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        replace_with_backups(self.tmp_path, self.path, SNAPSHOT_BACKUPS)
+
+    def abort(self):
+        self.f.close()
+        os.remove(self.tmp_path)
+
+class RoomsWriter(ObjectWriter):
+    """rooms.json по группам: сообщения комнаты пишутся сразу, заголовок — при закрытии группы"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.code = None
+        self.header = None
+        self.messages = 0
+        self.done = set()
+
+    def _open(self, code):
+        if code == self.code:
+            return
+        self.close_room()
+        if code in self.done:
+            raise ValueError(f"records of room {code!r} are not contiguous")
+        self.key(code)
+        self.f.write('{"messages":[')
+        self.code, self.header, self.messages = code, {}, 0
+
+    def message(self, code, message):
+        self._open(code)
+        self.f.write((',' if self.messages else '') + dumps(message))
+        self.messages += 1
+
+    def room(self, code, header):
+        self._open(code)
+        self.header.update({k: v for k, v in header.items() if k != 'messages'})
+
+    def close_room(self):
+        if self.code is None:
+            return
+        self.f.write(']')
+        for key, value in self.header.items():
+            self.f.write(',' + dumps(key) + ':' + dumps(value))
+        self.f.write('}')
+        self.done.add(self.code)
+        self.code = None
+
+    def commit(self):
+        self.close_room()
+        super().commit()
+
+# ----- Filters -----
+def parse_time(value):
+    """Unix-время или ISO-дата (локальное время, как у timestamp в сообщениях)"""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a date or timestamp: {value!r}")
+
+def in_range(message, since, until):
+    timestamp = message.get('timestamp') or 0
+    return (since is None or timestamp >= since) and (until is None or timestamp < until)
+
+def strip_avatar(user):
+    """Встроенный base64-аватар -> маркер 'file': load_users возьмет avatars/<id>.png или дефолтный"""
+    if user.get('avatar') and user['avatar'] != 'file':
+        user = {**user, 'avatar': 'file'}
+    return user
+
+def compact_message(message, drop_deleted):
+    """Убирает null-поля и base64-аватары, которые старые версии писали в каждое сообщение"""
+    if drop_deleted and message.get('deleted'):
+        return None
+    compacted = {k: v for k, v in message.items() if v is not None and k != 'avatar'}
+    if isinstance(compacted.get('file'), dict):
+        compacted['file'] = {k: v for k, v in compacted['file'].items() if v is not None}
+    return compacted
+
+# ----- Commands -----
+def cmd_export(args):
+    out = open(args.output, "w", encoding="utf-8") if args.output != '-' else sys.stdout
+    rooms_filter = set(args.room) if args.room else None
+    counts = {'room': 0, 'message': 0, 'user': 0}
+    try:
+        if not args.no_rooms and os.path.exists(args.rooms_file):
+            for code, kind, value in iter_rooms(args.rooms_file):
+                if rooms_filter is not None and code not in rooms_filter:
+                    continue
+                if kind == 'message':
+                    if not in_range(value, args.since, args.until):
+                        continue
+                    value.pop('avatar', None)
+                    out.write(dumps({'type': 'message', 'room': code, 'message': value}) + '\n')
+                else:
+                    out.write(dumps({'type': 'room', 'code': code, 'room': value}) + '\n')
+                counts[kind] += 1
+        if not args.no_users and os.path.exists(args.users_file):
+            for user_id, user in iter_users(args.users_file):
+                if args.strip_avatars:
+                    user = strip_avatar(user)
+                out.write(dumps({'type': 'user', 'id': user_id, 'user': user}) + '\n')
+                counts['user'] += 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(f"exported {counts['room']} rooms, {counts['message']} messages, {counts['user']} users", file=sys.stderr)
+
+def cmd_import(args):
+    rooms_writer = users_writer = None
+    counts = {'room': 0, 'message': 0, 'user': 0}
+    source = open(args.input, "r", encoding="utf-8") if args.input != '-' else sys.stdin
+    try:
+        for line_no, line in enumerate(source, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                kind = record['type']
+                if kind == 'message':
+                    rooms_writer = rooms_writer or RoomsWriter(args.rooms_file)
+                    rooms_writer.message(record['room'], record['message'])
+                elif kind == 'room':
+                    rooms_writer = rooms_writer or RoomsWriter(args.rooms_file)
+                    rooms_writer.room(record['code'], record['room'])
+                elif kind == 'user':
+                    users_writer = users_writer or ObjectWriter(args.users_file)
+                    users_writer.item(record['id'], record['user'])
+                else:
+                    raise ValueError(f"unknown record type {kind!r}")
+            except (ValueError, KeyError, TypeError) as e:
+                raise SystemExit(f"{args.input}:{line_no}: {e}")
+            counts[kind] += 1
+    except BaseException:
+        for writer in (rooms_writer, users_writer):
+            if writer:
+                writer.abort()
+        raise
+    finally:
+        if source is not sys.stdin:
+            source.close()
+    for writer in (rooms_writer, users_writer):
+        if writer:
+            writer.commit()
+    print(f"imported {counts['room']} rooms, {counts['message']} messages, {counts['user']} users", file=sys.stderr)
+
+def cmd_compact(args):
+    if os.path.exists(args.rooms_file):
+        writer = RoomsWriter(args.rooms_file)
+        kept = dropped = 0
+        try:
+            for code, kind, value in iter_rooms(args.rooms_file):
+                if kind == 'room':
+                    writer.room(code, value)
+                    continue
+                message = compact_message(value, args.drop_deleted)
+                if message is None:
+                    dropped += 1
+                    continue
+                writer.message(code, message)
+                kept += 1
+        except BaseException:
+            writer.abort()
+            raise
+        writer.commit()
+        print(f"{args.rooms_file}: {kept} messages kept, {dropped} dropped", file=sys.stderr)
+
+    if os.path.exists(args.users_file):
+        writer = ObjectWriter(args.users_file)
+        moved = 0
+        try:
+            for user_id, user in iter_users(args.users_file):
+                if args.strip_avatars and user.get('avatar') and user['avatar'] != 'file':
+                    moved += save_avatar_file(user_id, user['avatar'])
+                    user = strip_avatar(user)
+                writer.item(user_id, user)
+        except BaseException:
+            writer.abort()
+            raise
+        writer.commit()
+        print(f"{args.users_file}: {writer.count} users, {moved} avatars moved to {app.config['AVATARS_ROOT']}", file=sys.stderr)
+
+def save_avatar_file(user_id, avatar_b64):
+    """Переносит встроенный аватар в avatars/<id>.png, если файла еще нет"""
+    avatars_root = app.config['AVATARS_ROOT']
+    path = os.path.join(avatars_root, f"{user_id}.png")
+    if os.path.exists(path):
+        return 0
+    os.makedirs(avatars_root, exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(base64.b64decode(avatar_b64))
+    return 1
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Streaming export/import and compaction of rooms.json and users.json")
+    parser.add_argument('--rooms-file', default=app.config['STORAGE_FILE'])
+    parser.add_argument('--users-file', default=app.config['USERS_FILE'])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export = commands.add_parser('export', help="rooms, messages and users to NDJSON")
+    export.add_argument('-o', '--output', default='-')
+    export.add_argument('--room', action='append', help="only this room code (repeatable)")
+    export.add_argument('--since', type=parse_time, help="messages at or after this date/timestamp")
+    export.add_argument('--until', type=parse_time, help="messages before this date/timestamp")
+    export.add_argument('--strip-avatars', action='store_true', help="replace embedded avatars with the 'file' marker")
+    export.add_argument('--no-rooms', action='store_true')
+    export.add_argument('--no-users', action='store_true')
+    export.set_defaults(func=cmd_export)
+
+    imp = commands.add_parser('import', help="rewrite data files from NDJSON (previous files kept as .1)")
+    imp.add_argument('input', help="NDJSON file or - for stdin")
+    imp.set_defaults(func=cmd_import)
+
+    compact = commands.add_parser('compact', help="rewrite data files in place without nulls and per-message avatars")
+    compact.add_argument('--drop-deleted', action='store_true', help="remove deleted-message placeholders")
+    compact.add_argument('--strip-avatars', action='store_true', help="move embedded avatars to avatars/<id>.png")
+    compact.set_defaults(func=cmd_compact)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -9,12 +9,40 @@ import time
 import hashlib
 import hmac
 import math
+import gzip
+import sys
+import heapq
+import bisect
+import shutil
+import smtplib
+import tracemalloc
+import queue
+import atexit
+import logging
+import threading
+import wave
+from collections import Counter, deque
+from contextlib import contextmanager
 from datetime import datetime
+from functools import wraps
+from logging.handlers import QueueHandler, QueueListener
 from string import ascii_letters
 from io import BytesIO
-from PIL import Image, ImageOps
+from urllib.parse import quote
+from email.message import EmailMessage
+from PIL import Image, ImageOps, features
 from flask import Flask, request, render_template, redirect, url_for, session, jsonify, send_file, Response
-from flask_socketio import SocketIO, join_room, leave_room, send
+from flask_socketio import SocketIO, join_room, leave_room, send, emit
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # ----- App setup -----
 app = Flask(__name__)
@@ -22,51 +50,371 @@ app.config["SECRET_KEY"] = "postpunksecretkey123"
 app.config['SESSION_COOKIE_MAX_SIZE'] = 4096 * 4
 socketio = SocketIO(app)
 
+# ----- Logging -----
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+ROOM_CHECK_LOG_SAMPLE_RATE = float(os.environ.get('ROOM_CHECK_LOG_SAMPLE_RATE', '0.01'))
+
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'sample_rate'}
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись; поля из extra= попадают в объект как есть"""
+
+    def format(self, record):
+        payload = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                payload[key] = value
+        if record.exc_info:
+            payload['exc'] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+class SamplingFilter(logging.Filter):
+    """Пропускает только долю записей с extra={'sample_rate': ...}"""
+
+    def filter(self, record):
+        rate = getattr(record, 'sample_rate', None)
+        return rate is None or random.random() < rate
+
+class DeferredQueueHandler(QueueHandler):
+    """Кладет запись в очередь без форматирования — форматирует поток QueueListener"""
+
+    def prepare(self, record):
+        return record
+
+log = logging.getLogger('punk')
+log_listener = None
+
+def setup_logging():
+    global log_listener
+    if log_listener is not None:
+        return log_listener
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+    log.addHandler(queue_handler)
+    log.setLevel(LOG_LEVEL)
+    log.propagate = False
+
+    listener.start()
+    atexit.register(listener.stop)
+    log_listener = listener
+    return listener
+
+# ----- TTL store -----
+class TTLStore:
+    """Словарь с истечением записей по времени и ограничением размера.
+
+    Просроченные ключи удаляются лениво при обращении и пачкой в sweep();
+    порядок истечения хранится в куче. При переполнении вытесняются записи,
+    которые истекают раньше всех.
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = {}
+        self._heap = []
+        self._lock = threading.Lock()
+
+    def _expired(self, key, now):
+        entry = self._data.get(key)
+        return entry is not None and entry[0] <= now
+
+    def _drop_if_expired(self, key, now):
+        if self._expired(key, now):
+            del self._data[key]
+
+    def _pop_heap(self):
+        while self._heap:
+            expires_at, key = heapq.heappop(self._heap)
+            entry = self._data.get(key)
+            if entry is not None and entry[0] == expires_at:
+                return key
+        return None
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            heapq.heappush(self._heap, (expires_at, key))
+            while len(self._data) > self.max_size:
+                victim = self._pop_heap()
+                if victim is None:
+                    break
+                del self._data[victim]
+            if len(self._heap) > 2 * len(self._data) + 64:
+                self._heap = [(entry[0], k) for k, entry in self._data.items()]
+                heapq.heapify(self._heap)
+
+    def get(self, key, default=None):
+        with self._lock:
+            self._drop_if_expired(key, time.time())
+            entry = self._data.get(key)
+        return default if entry is None else entry[1]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            self._drop_if_expired(key, time.time())
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def sweep(self):
+        now = time.time()
+        removed = 0
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                expires_at, key = heapq.heappop(self._heap)
+                entry = self._data.get(key)
+                if entry is not None and entry[0] == expires_at:
+                    del self._data[key]
+                    removed += 1
+        return removed
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __getitem__(self, key):
+        with self._lock:
+            self._drop_if_expired(key, time.time())
+            return self._data[key][1]
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
+
+    def __contains__(self, key):
+        with self._lock:
+            self._drop_if_expired(key, time.time())
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+ttl_stores = []
+
+def ttl_sweeper(interval):
+    while True:
+        time.sleep(interval)
+        for store in ttl_stores:
+            removed = store.sweep()
+            if removed:
+                log.debug("ttl sweep", extra={'removed': removed, 'remaining': len(store)})
+
 # ----- Storage -----
 UPLOAD_ROOT = os.path.join(os.getcwd(), "uploads")
 AVATARS_ROOT = os.path.join(os.getcwd(), "avatars")
 THUMBNAILS_ROOT = os.path.join(os.getcwd(), "thumbnails")
-os.makedirs(UPLOAD_ROOT, exist_ok=True)
-os.makedirs(AVATARS_ROOT, exist_ok=True)
-os.makedirs(THUMBNAILS_ROOT, exist_ok=True)
+DEFAULT_AVATAR_FILE = "_default.png"
 
 rooms = {}
 users = {}
-sessions = {}
-verification_codes = {}
 
 default_avatar = None
 
 STORAGE_FILE = "rooms.json"
 USERS_FILE = "users.json"
+SEARCH_INDEX_FILE = "search_index.json"
+READ_STATE_FILE = "read_state.json"
+
+# Значения по умолчанию; create_app(config) может их переопределить, код читает пути из app.config
+app.config.setdefault('STORAGE_FILE', STORAGE_FILE)
+app.config.setdefault('USERS_FILE', USERS_FILE)
+app.config.setdefault('SEARCH_INDEX_FILE', SEARCH_INDEX_FILE)
+app.config.setdefault('READ_STATE_FILE', READ_STATE_FILE)
+app.config.setdefault('UPLOAD_ROOT', UPLOAD_ROOT)
+app.config.setdefault('AVATARS_ROOT', AVATARS_ROOT)
+app.config.setdefault('THUMBNAILS_ROOT', THUMBNAILS_ROOT)
+
+# ----- Media offload -----
+# '' — отдаем файлы сами, 'nginx' — X-Accel-Redirect, 'sendfile' — X-Sendfile (Apache/lighttpd)
+MEDIA_OFFLOAD_MODES = ('', 'nginx', 'sendfile')
+app.config.setdefault('MEDIA_OFFLOAD', os.environ.get('MEDIA_OFFLOAD', '').lower())
+app.config.setdefault('MEDIA_ACCEL_UPLOADS_PREFIX', '/_protected/uploads/')
+app.config.setdefault('MEDIA_ACCEL_THUMBNAILS_PREFIX', '/_protected/thumbnails/')
 
 # ----- File size limit -----
 MAX_UPLOAD_SIZE = 400 * 1024 * 1024
 
+# ----- Disk quotas and upload GC -----
+ROOM_DISK_QUOTA = int(os.environ.get('ROOM_DISK_QUOTA', 2 * 1024 * 1024 * 1024))
+GLOBAL_DISK_QUOTA = int(os.environ.get('GLOBAL_DISK_QUOTA', 50 * 1024 * 1024 * 1024))
+UPLOAD_GC_INTERVAL = 10 * 60
+UPLOAD_GC_GRACE = 60 * 60
+
 # ----- Конфигурация аутентификации -----
 VERIFICATION_CODE_EXPIRY = 300
 SESSION_EXPIRY = 30 * 24 * 60 * 60
+MAX_PENDING_VERIFICATIONS = 10000
+MAX_SESSIONS = 100000
+TTL_SWEEP_INTERVAL = 30
+
+sessions = TTLStore(SESSION_EXPIRY, MAX_SESSIONS)
+verification_codes = TTLStore(VERIFICATION_CODE_EXPIRY, MAX_PENDING_VERIFICATIONS)
+ttl_stores.extend([sessions, verification_codes])
+
+# ----- Администрирование и профилирование -----
+ADMIN_EMAILS = {e.strip().lower() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()}
+SLOW_REQUEST_THRESHOLD = float(os.environ.get('SLOW_REQUEST_THRESHOLD', '0.5'))
+SLOW_LOG_SIZE = 500
+PROFILER_INTERVAL = 0.005
+PROFILER_MAX_DURATION = 300
+
+# ----- Timing buckets -----
+slow_log = deque(maxlen=SLOW_LOG_SIZE)
+_timings = threading.local()
+
+@contextmanager
+def timed(category):
+    """Добавляет время блока к текущему запросу/событию (persistence, pil, hashing)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        buckets = getattr(_timings, 'buckets', None)
+        if buckets is not None:
+            buckets[category] = buckets.get(category, 0.0) + time.perf_counter() - start
+
+def begin_timing():
+    _timings.buckets = {}
+    _timings.started = time.perf_counter()
+
+def end_timing(kind, name):
+    buckets = getattr(_timings, 'buckets', None)
+    if buckets is None:
+        return
+    _timings.buckets = None
+    duration = time.perf_counter() - _timings.started
+    if duration < SLOW_REQUEST_THRESHOLD:
+        return
+    entry = {
+        'kind': kind,
+        'name': name,
+        'duration': round(duration, 4),
+        'persistence': round(buckets.get('persistence', 0.0), 4),
+        'pil': round(buckets.get('pil', 0.0), 4),
+        'hashing': round(buckets.get('hashing', 0.0), 4),
+        'timestamp': time.time()
+    }
+    slow_log.append(entry)
+    log.warning("slow %s %s", kind, name, extra={'slow': entry})
+
+def timed_event(name):
+    """Оборачивает socket-обработчик в замер для slow-лога"""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            begin_timing()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                end_timing('event', name)
+        return wrapper
+    return decorator
+
+# ----- Sampling profiler -----
+class SamplingProfiler:
+    """Периодически снимает стеки всех потоков и копит их в folded-формате для flamegraph.pl/speedscope"""
+
+    def __init__(self, interval=PROFILER_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.started_at = None
+        self.stop_at = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration):
+        """Новый прогон — только после выхода предыдущего потока: у каждого свой Event и свой Counter"""
+        with self._lock:
+            if self.running:
+                return False
+            self.stacks = Counter()
+            self.samples = 0
+            self.started_at = time.time()
+            self.stop_at = self.started_at + duration
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(self._stop, self.stacks, self.stop_at),
+                                            name='sampling-profiler', daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        with self._lock:
+            thread = self._thread
+            self._stop.set()
+        if thread is not None:
+            thread.join(timeout=self.interval * 10 + 1)
+
+    def _run(self, stop, stacks, stop_at):
+        own_id = threading.get_ident()
+        while not stop.is_set() and time.time() < stop_at:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    stacks[self._fold(frame)] += 1
+            self.samples += 1
+            stop.wait(self.interval)
+
+    @staticmethod
+    def _fold(frame):
+        parts = []
+        while frame is not None:
+            code = frame.f_code
+            parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ';'.join(reversed(parts))
+
+    def status(self):
+        return {
+            'running': self.running,
+            'started_at': self.started_at,
+            'stop_at': self.stop_at,
+            'samples': self.samples,
+            'interval': self.interval
+        }
+
+    def folded(self):
+        return '\n'.join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+profiler = SamplingProfiler()
 
 # ----- Password hashing -----
 def hash_password(password):
     salt = os.urandom(32)
-    key = hashlib.pbkdf2_hmac(
-        'sha256',
-        password.encode('utf-8'),
-        salt,
-        100000
-    )
+    with timed('hashing'):
+        key = hashlib.pbkdf2_hmac(
+            'sha256',
+            password.encode('utf-8'),
+            salt,
+            100000
+        )
     return salt + key
 
 def verify_password(stored_password, provided_password):
     salt = stored_password[:32]
     stored_key = stored_password[32:]
-    key = hashlib.pbkdf2_hmac(
-        'sha256',
-        provided_password.encode('utf-8'),
-        salt,
-        100000
-    )
+    with timed('hashing'):
+        key = hashlib.pbkdf2_hmac(
+            'sha256',
+            provided_password.encode('utf-8'),
+            salt,
+            100000
+        )
     return hmac.compare_digest(stored_key, key)
 
 # ----- Default avatar -----
@@ -85,71 +433,665 @@ def create_default_avatar():
     
     buffer = BytesIO()
     img.save(buffer, format="PNG")
-    return base64.b64encode(buffer.getvalue()).decode('utf-8')
+    return buffer.getvalue()
+
+def load_default_avatar():
+    """Рисует аватар по умолчанию один раз и дальше читает его из файла"""
+    global default_avatar
+    avatar_path = os.path.join(app.config['AVATARS_ROOT'], DEFAULT_AVATAR_FILE)
+    if os.path.exists(avatar_path):
+        with open(avatar_path, 'rb') as f:
+            data = f.read()
+    else:
+        with timed('pil'):
+            data = create_default_avatar()
+        with open(avatar_path, 'wb') as f:
+            f.write(data)
+    default_avatar = base64.b64encode(data).decode('utf-8')
+
+# ----- Message records -----
+class Record:
+    """Компактная запись на __slots__ с dict-подобным чтением (get, [], in)"""
+    __slots__ = ()
+
+    def get(self, key, default=None):
+        value = getattr(self, key) if key in self.__slots__ else None
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.__slots__ and getattr(self, key) is not None
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__ if getattr(self, key) is not None}
+
+def intern_str(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+class FileMeta(Record):
+    __slots__ = ('kind', 'name', 'type', 'url', 'peaks', 'duration', 'width', 'height', 'orientation', 'placeholder')
+
+    def __init__(self, kind=None, name=None, type=None, url=None, peaks=None, duration=None,
+                 width=None, height=None, orientation=None, placeholder=None):
+        self.kind = intern_str(kind)
+        self.name = name
+        self.type = intern_str(type)
+        self.url = url
+        self.peaks = peaks
+        self.duration = duration
+        self.width = width
+        self.height = height
+        self.orientation = intern_str(orientation)
+        self.placeholder = placeholder
+
+class Message(Record):
+    """Сообщение комнаты. Имена и user_id интернированы — в истории они
+    повторяются тысячи раз; base64-аватар в записи не хранится."""
+    __slots__ = ('sender', 'message', 'user_id', 'timestamp', 'seq', 'file', 'deleted')
+
+    def __init__(self, sender, message='', user_id=None, timestamp=None, seq=None, file=None, deleted=None):
+        self.sender = intern_str(sender)
+        self.message = message
+        self.user_id = intern_str(user_id)
+        self.timestamp = timestamp
+        self.seq = seq
+        self.file = file
+        self.deleted = deleted or None
+
+    @classmethod
+    def from_dict(cls, data):
+        file_meta = data.get('file')
+        return cls(
+            sender=data.get('sender'),
+            message=data.get('message', ''),
+            user_id=data.get('user_id'),
+            timestamp=data.get('timestamp'),
+            seq=data.get('seq'),
+            file=FileMeta(**{k: file_meta.get(k) for k in FileMeta.__slots__}) if isinstance(file_meta, dict) else None,
+            deleted=data.get('deleted')
+        )
+
+    def to_dict(self):
+        data = super().to_dict()
+        if self.file is not None:
+            data['file'] = self.file.to_dict()
+        return data
+
+def encode_record(obj):
+    """default= для json.dump: сериализует Message/FileMeta"""
+    if isinstance(obj, Record):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+# ----- Memory accounting -----
+MEMORY_TOP_ROOMS = 20
+TRACEMALLOC_FRAMES = 10
+
+def message_size(message):
+    """Оценка байт на сообщение: запись, текст и метаданные файла (интернированные строки не считаем)"""
+    size = sys.getsizeof(message) + sys.getsizeof(message.get('message', ''))
+    file_meta = message.get('file')
+    if file_meta:
+        size += sys.getsizeof(file_meta) + sys.getsizeof(file_meta.get('name', '')) + sys.getsizeof(file_meta.get('url', ''))
+        if file_meta.get('peaks'):
+            size += sys.getsizeof(file_meta['peaks'])
+    return size
+
+class MemoryStats:
+    """Оценки занимаемой памяти по комнатам, обновляемые вместе с сообщениями"""
+
+    def __init__(self):
+        self.rooms = {}
+        self._lock = threading.Lock()
+
+    def add(self, room_code, message):
+        with self._lock:
+            stats = self.rooms.setdefault(room_code, [0, 0])
+            stats[0] += 1
+            stats[1] += message_size(message)
+
+    def remove(self, room_code, message):
+        with self._lock:
+            stats = self.rooms.get(room_code)
+            if stats:
+                stats[0] = max(0, stats[0] - 1)
+                stats[1] = max(0, stats[1] - message_size(message))
+
+    def drop_room(self, room_code):
+        with self._lock:
+            self.rooms.pop(room_code, None)
+
+    def rebuild(self, all_rooms):
+        fresh = {code: [len(info['messages']), sum(message_size(m) for m in info['messages'])]
+                 for code, info in all_rooms.items()}
+        with self._lock:
+            self.rooms = fresh
+
+    def report(self, top=MEMORY_TOP_ROOMS):
+        with self._lock:
+            ranked = sorted(self.rooms.items(), key=lambda item: -item[1][1])
+            total_messages = sum(stats[0] for stats in self.rooms.values())
+            total_bytes = sum(stats[1] for stats in self.rooms.values())
+        return {
+            'rooms': len(ranked),
+            'messages': total_messages,
+            'message_bytes': total_bytes,
+            'top_rooms': [{'room': code, 'messages': count, 'bytes': size} for code, (count, size) in ranked[:top]]
+        }
 
-default_avatar = create_default_avatar()
+memory_stats = MemoryStats()
+tracemalloc_baseline = None
 
-# ----- Persistence helpers -----
-def save_rooms():
+def process_rss():
     try:
-        with open(STORAGE_FILE, "w", encoding="utf-8") as f:
-            json.dump(rooms, f)
-    except Exception as e:
-        print(f"[Persistence] Save failed: {e}")
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
 
-def load_rooms():
-    global rooms
-    if os.path.exists(STORAGE_FILE):
+# ----- Message search index -----
+SEARCH_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+SEARCH_MIN_TOKEN = 2
+SEARCH_MAX_PER_PAGE = 50
+SEARCH_INDEX_VERSION = 1
+
+def tokenize(text):
+    return [t for t in SEARCH_TOKEN_RE.findall((text or '').lower()) if len(t) >= SEARCH_MIN_TOKEN]
+
+def message_key(message):
+    return repr(message.get('timestamp'))
+
+class MessageIndex:
+    """Инвертированный индекс по тексту сообщений, отдельный для каждой комнаты.
+
+    Документ — сообщение, ключ — repr(timestamp). Обновляется инкрементально
+    при отправке/удалении сообщений и сохраняется рядом с rooms.json; при
+    сохранении заново сериализуются только измененные комнаты.
+    """
+
+    def __init__(self):
+        self.rooms = {}
+        self._dirty = set()
+        self._encoded = {}
+        self._lock = threading.Lock()
+
+    def replace(self, rooms):
+        with self._lock:
+            self.rooms = rooms
+            self._dirty = set(rooms)
+            self._encoded = {}
+
+    @staticmethod
+    def _new_room():
+        return {'postings': {}, 'docs': {}, 'authors': {}, 'total_length': 0}
+
+    def add(self, room_code, message):
+        if message.get('sender') == 'System' or message.get('deleted'):
+            return
+        tokens = tokenize(message.get('message'))
+        if not tokens:
+            return
+        key = message_key(message)
+        counts = Counter(tokens)
+        with self._lock:
+            room_index = self.rooms.setdefault(room_code, self._new_room())
+            if key in room_index['docs']:
+                return
+            self._dirty.add(room_code)
+            room_index['docs'][key] = len(tokens)
+            room_index['total_length'] += len(tokens)
+            for token, tf in counts.items():
+                room_index['postings'].setdefault(token, {})[key] = tf
+            author = message.get('user_id')
+            if author:
+                room_index['authors'][author] = room_index['authors'].get(author, 0) + 1
+
+    def remove(self, room_code, message):
+        key = message_key(message)
+        with self._lock:
+            room_index = self.rooms.get(room_code)
+            if not room_index or key not in room_index['docs']:
+                return
+            self._dirty.add(room_code)
+            room_index['total_length'] -= room_index['docs'].pop(key)
+            for token in set(tokenize(message.get('message'))):
+                postings = room_index['postings'].get(token)
+                if postings is not None:
+                    postings.pop(key, None)
+                    if not postings:
+                        del room_index['postings'][token]
+            author = message.get('user_id')
+            if author in room_index['authors']:
+                room_index['authors'][author] -= 1
+                if room_index['authors'][author] <= 0:
+                    del room_index['authors'][author]
+
+    def drop_room(self, room_code):
+        with self._lock:
+            self.rooms.pop(room_code, None)
+            self._dirty.add(room_code)
+
+    def rebuild_room(self, room_code, messages):
+        self.drop_room(room_code)
+        for message in messages:
+            self.add(room_code, message)
+
+    def has_author(self, room_code, user_id):
+        room_index = self.rooms.get(room_code)
+        return bool(room_index) and user_id in room_index['authors']
+
+    def search(self, room_codes, query, k1=1.2, b=0.75):
+        """BM25 по каждой комнате; все слова запроса должны встретиться в сообщении"""
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        hits = []
+        with self._lock:
+            for room_code in room_codes:
+                room_index = self.rooms.get(room_code)
+                if not room_index or not room_index['docs']:
+                    continue
+                postings = [room_index['postings'].get(term) for term in terms]
+                if not all(postings):
+                    continue
+                postings.sort(key=len)
+                n_docs = len(room_index['docs'])
+                avg_length = room_index['total_length'] / n_docs
+                for key in postings[0]:
+                    if not all(key in p for p in postings[1:]):
+                        continue
+                    length = room_index['docs'][key]
+                    score = 0.0
+                    for p in postings:
+                        tf = p[key]
+                        idf = math.log(1 + (n_docs - len(p) + 0.5) / (len(p) + 0.5))
+                        score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / avg_length))
+                    hits.append((score, float(key), room_code))
+        hits.sort(key=lambda h: (-h[0], -h[1]))
+        return hits
+
+    def snapshot(self):
+        """Пересериализует только комнаты, измененные с прошлого снимка. Лок держится
+        на копию одной комнаты, а не всего индекса: add()/search() между комнатами не ждут.
+        Зовется только из search_index_persister, поэтому _encoded без отдельного лока."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        for code in dirty:
+            with self._lock:
+                idx = self.rooms.get(code)
+                copy = None if idx is None else {
+                    'postings': {token: dict(p) for token, p in idx['postings'].items()},
+                    'docs': dict(idx['docs']),
+                    'authors': dict(idx['authors']),
+                    'total_length': idx['total_length']
+                }
+            if copy is None:
+                self._encoded.pop(code, None)
+            else:
+                self._encoded[code] = json.dumps(copy)
+        return {'version': SEARCH_INDEX_VERSION, 'rooms': dict(self._encoded)}
+
+    @staticmethod
+    def dump(snapshot, f):
+        """Записывает снимок, склеивая уже сериализованные комнаты"""
+        f.write(f'{{"version": {snapshot["version"]}, "rooms": {{')
+        for i, (code, encoded) in enumerate(snapshot['rooms'].items()):
+            f.write(f'{", " if i else ""}{json.dumps(code)}: {encoded}')
+        f.write('}}')
+
+search_index = MessageIndex()
+
+def load_search_index():
+    """Загружает индекс и переиндексирует только комнаты, которые с ним разошлись"""
+    loaded = {}
+    if os.path.exists(app.config['SEARCH_INDEX_FILE']):
         try:
-            with open(STORAGE_FILE, "r", encoding="utf-8") as f:
-                rooms = json.load(f)
-                for code in rooms:
-                    rooms[code]["members"] = 0
+            with open(app.config['SEARCH_INDEX_FILE'], "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get('version') == SEARCH_INDEX_VERSION:
+                loaded = data.get('rooms', {})
         except Exception as e:
-            print(f"[Persistence] Load failed: {e}")
+            log.error("search index load failed: %s", e)
+    search_index.replace({code: idx for code, idx in loaded.items() if code in rooms})
+    rebuilt = 0
+    for code, room_info in rooms.items():
+        room_index = search_index.rooms.get(code)
+        last = next((m for m in reversed(room_info['messages']) if tokenize(m.get('message'))
+                     and m.get('sender') != 'System' and not m.get('deleted')), None)
+        if last is None and room_index is None:
+            continue
+        if room_index is None or last is None or message_key(last) not in room_index['docs']:
+            search_index.rebuild_room(code, room_info['messages'])
+            rebuilt += 1
+    log.info("search index loaded", extra={'rooms': len(search_index.rooms), 'rebuilt': rebuilt})
+
+def find_message(room_code, timestamp):
+    """Сообщения добавляются по времени, поэтому ищем бинарным поиском"""
+    messages = rooms.get(room_code, {}).get('messages', [])
+    lo = bisect.bisect_left(messages, timestamp, key=lambda m: m.get('timestamp', 0))
+    for i in (lo, lo - 1):
+        if 0 <= i < len(messages) and messages[i].get('timestamp') == timestamp:
+            return i, messages[i]
+    for i, message in enumerate(messages):
+        if message.get('timestamp') == timestamp:
+            return i, message
+    return None, None
+
+# ----- Read cursors and unread counters -----
+READ_STATE_FLUSH_INTERVAL = 5
+
+class ReadState:
+    """Курсоры прочтения: user_id -> room_code -> [read_at, unread].
+
+    Счетчики меняются при добавлении/удалении сообщений, чтение за O(1).
+    Подтверждения только помечают состояние грязным — на диск его пишет
+    read_state_flusher раз в READ_STATE_FLUSH_INTERVAL секунд.
+    """
+
+    def __init__(self):
+        self.cursors = {}
+        self.dirty = False
+        self._lock = threading.Lock()
+
+    def on_message(self, room_code, message, readers):
+        timestamp = message.get('timestamp', 0)
+        with self._lock:
+            for user_id in readers:
+                cursor = self.cursors.setdefault(user_id, {}).setdefault(room_code, [0.0, 0])
+                if timestamp > cursor[0]:
+                    cursor[1] += 1
+                    self.dirty = True
+
+    def on_delete(self, room_code, message, readers):
+        timestamp = message.get('timestamp', 0)
+        with self._lock:
+            for user_id in readers:
+                cursor = self.cursors.get(user_id, {}).get(room_code)
+                if cursor and cursor[1] > 0 and timestamp > cursor[0]:
+                    cursor[1] -= 1
+                    self.dirty = True
+
+    def mark_read(self, user_id, room_code, messages, timestamp=None):
+        """Сдвигает курсор до timestamp; счетчик обнуляется, только если прочитано
+        все до последнего сообщения, иначе пересчитываются сообщения после курсора"""
+        with self._lock:
+            cursor = self.cursors.setdefault(user_id, {}).setdefault(room_code, [0.0, 0])
+            # Время от клиента не может опережать сервер, иначе курсор скроет будущие сообщения
+            now = time.time()
+            read_at = max(cursor[0], min(timestamp, now) if timestamp else now)
+            unread = 0
+            # С конца: плейсхолдеры удаленных несут время удаления, поэтому их пропускаем, а не бисектим
+            for message in reversed(messages):
+                if message.get('deleted'):
+                    continue
+                if message.get('timestamp', 0) <= read_at:
+                    break
+                if message.get('user_id') not in (None, user_id):
+                    unread += 1
+            if unread != cursor[1] or read_at != cursor[0]:
+                cursor[0] = read_at
+                cursor[1] = unread
+                self.dirty = True
+
+    def unread(self, user_id, room_code):
+        cursor = self.cursors.get(user_id, {}).get(room_code)
+        return cursor[1] if cursor else 0
+
+    def drop_room(self, room_code):
+        with self._lock:
+            for per_room in self.cursors.values():
+                if per_room.pop(room_code, None) is not None:
+                    self.dirty = True
+
+    def snapshot(self):
+        with self._lock:
+            self.dirty = False
+            return {user_id: {code: list(cursor) for code, cursor in per_room.items()}
+                    for user_id, per_room in self.cursors.items()}
+
+read_state = ReadState()
+room_presence = {}
+online_users = Counter()
+_presence_lock = threading.Lock()
+
+def presence_join(room_code, user_id):
+    with _presence_lock:
+        room_presence.setdefault(room_code, Counter())[user_id] += 1
+        online_users[user_id] += 1
+
+def presence_leave(room_code, user_id):
+    with _presence_lock:
+        present = room_presence.get(room_code)
+        if present is None:
+            return
+        online_users[user_id] -= 1
+        if online_users[user_id] <= 0:
+            del online_users[user_id]
+        present[user_id] -= 1
+        if present[user_id] <= 0:
+            del present[user_id]
+        if not present:
+            del room_presence[room_code]
+
+def is_room_reader(room_info, user_id):
+    """Курсоры прочтения ведутся только для участников личных чатов"""
+    return bool(room_info.get('private')) and user_id in room_info.get('participants', [])
+
+def mark_room_read(room_code, user_id, timestamp=None):
+    room_info = rooms.get(room_code)
+    if room_info is None or not is_room_reader(room_info, user_id):
+        return False
+    read_state.mark_read(user_id, room_code, room_info['messages'], timestamp)
+    return True
 
-def save_users():
+def unread_readers(room_info, room_code, author_id=None):
+    """Кому считать непрочитанное: участники личного чата, кроме автора и тех, кто сейчас в комнате"""
+    if not room_info.get('private'):
+        return []
+    present = room_presence.get(room_code, ())
+    return [uid for uid in room_info.get('participants', []) if uid != author_id and uid not in present]
+
+def save_read_state():
     try:
-        with open(USERS_FILE, "w", encoding="utf-8") as f:
-            users_to_save = {}
-            for user_id, user_data in users.items():
-                user_data_copy = user_data.copy()
-                if 'password_hash' in user_data_copy and isinstance(user_data_copy['password_hash'], bytes):
-                    user_data_copy['password_hash'] = base64.b64encode(user_data_copy['password_hash']).decode('utf-8')
-                if 'avatar' in user_data_copy and user_data_copy['avatar'] and len(user_data_copy['avatar']) > 10000:
-                    user_data_copy['avatar'] = 'file'
-                users_to_save[user_id] = user_data_copy
-            json.dump(users_to_save, f)
-        print(f"Users saved successfully. Total users: {len(users)}")
+        snapshot = read_state.snapshot()
+        with timed('persistence'):
+            atomic_write_json(app.config['READ_STATE_FILE'], snapshot)
     except Exception as e:
-        print(f"[Users] Save failed: {e}")
+        read_state.dirty = True
+        log.error("read state save failed: %s", e)
 
-def load_users():
-    global users
-    if os.path.exists(USERS_FILE):
+def load_read_state():
+    if os.path.exists(app.config['READ_STATE_FILE']):
         try:
-            with open(USERS_FILE, "r", encoding="utf-8") as f:
-                users_loaded = json.load(f)
-                for user_id, user_data in users_loaded.items():
-                    if 'password_hash' in user_data and isinstance(user_data['password_hash'], str):
-                        user_data['password_hash'] = base64.b64decode(user_data['password_hash'])
-                    if user_data.get('avatar') == 'file':
-                        avatar_path = os.path.join(AVATARS_ROOT, f"{user_id}.png")
-                        if os.path.exists(avatar_path):
-                            with open(avatar_path, 'rb') as avatar_file:
-                                user_data['avatar'] = base64.b64encode(avatar_file.read()).decode('utf-8')
-                        else:
-                            user_data['avatar'] = default_avatar
-                users = users_loaded
-            print(f"Users loaded successfully. Total users: {len(users)}")
+            with open(app.config['READ_STATE_FILE'], "r", encoding="utf-8") as f:
+                read_state.cursors = json.load(f)
         except Exception as e:
-            print(f"[Users] Load failed: {e}")
-            users = {}
-    else:
-        users = {}
+            log.error("read state load failed: %s", e)
+
+def read_state_flusher(interval):
+    while True:
+        time.sleep(interval)
+        if read_state.dirty:
+            save_read_state()
+
+# ----- Snapshot persistence -----
+SNAPSHOT_BACKUPS = 3
+SNAPSHOT_MIN_INTERVAL = 1.0
+
+# Держат все изменения структуры rooms и списков сообщений; снимок берется под ним же
+rooms_lock = threading.RLock()
+
+def dump_json(data, f):
+    json.dump(data, f, default=encode_record)
+
+def atomic_write_json(path, data, backups=0, dump=dump_json):
+    """Пишет во временный файл, fsync, сдвигает копии path.1..path.N и подменяет через rename"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    replace_with_backups(tmp_path, path, backups)
+
+def replace_with_backups(tmp_path, path, backups=0):
+    """Сдвигает копии path.1..path.N, подменяет path записанным tmp_path и делает fsync каталога"""
+    if backups and os.path.exists(path):
+        for i in range(backups - 1, 0, -1):
+            if os.path.exists(f"{path}.{i}"):
+                os.replace(f"{path}.{i}", f"{path}.{i + 1}")
+        if os.path.exists(f"{path}.1"):
+            os.remove(f"{path}.1")
+        try:
+            os.link(path, f"{path}.1")
+        except OSError:
+            shutil.copy2(path, f"{path}.1")
+    os.replace(tmp_path, path)
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def read_json_with_backups(path, backups=SNAPSHOT_BACKUPS):
+    """Читает path, а если он битый или отсутствует — самую свежую целую копию"""
+    for candidate in [path] + [f"{path}.{i}" for i in range(1, backups + 1)]:
+        if not os.path.exists(candidate):
+            continue
+        try:
+            with open(candidate, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if candidate != path:
+                log.warning("recovered from backup", extra={'path': candidate})
+            return data
+        except Exception as e:
+            log.error("snapshot load failed: %s", e, extra={'path': candidate})
+    return None
+
+class SnapshotPersister:
+    """Сохраняет состояние в фоне: запросы на запись схлопываются,
+    снимок берется быстро под блокировкой, сериализация — вне ее."""
+
+    def __init__(self, name, path, snapshot, backups=SNAPSHOT_BACKUPS, min_interval=SNAPSHOT_MIN_INTERVAL, dump=dump_json):
+        self.name = name
+        self.path = path
+        self.snapshot = snapshot
+        self.dump = dump
+        self.backups = backups
+        self.min_interval = min_interval
+        self.version = 0
+        self.written_version = 0
+        self._pending = threading.Event()
+        self._write_lock = threading.Lock()
+        self._version_lock = threading.Lock()
+
+    def request(self):
+        with self._version_lock:
+            self.version += 1
+        self._pending.set()
+
+    def flush(self):
+        with self._write_lock:
+            version = self.version
+            if version == self.written_version:
+                return
+            started = time.perf_counter()
+            atomic_write_json(self.path(), self.snapshot(), self.backups, self.dump)
+            self.written_version = version
+        log.debug("snapshot written", extra={'snapshot': self.name, 'seconds': round(time.perf_counter() - started, 4)})
+
+    def run(self):
+        while True:
+            self._pending.wait()
+            self._pending.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                log.error("snapshot save failed: %s", e, extra={'snapshot': self.name})
+                self._pending.set()
+            time.sleep(self.min_interval)
+
+def snapshot_rooms():
+    with rooms_lock:
+        return {code: {**info, 'messages': list(info['messages'])} for code, info in rooms.items()}
+
+def snapshot_users():
+    users_to_save = {}
+    for user_id, user_data in list(users.items()):
+        user_data_copy = user_data.copy()
+        if 'password_hash' in user_data_copy and isinstance(user_data_copy['password_hash'], bytes):
+            user_data_copy['password_hash'] = base64.b64encode(user_data_copy['password_hash']).decode('utf-8')
+        if 'avatar' in user_data_copy and user_data_copy['avatar'] and len(user_data_copy['avatar']) > 10000:
+            user_data_copy['avatar'] = 'file'
+        users_to_save[user_id] = user_data_copy
+    return users_to_save
+
+rooms_persister = SnapshotPersister('rooms', lambda: app.config['STORAGE_FILE'], snapshot_rooms)
+search_index_persister = SnapshotPersister('search_index', lambda: app.config['SEARCH_INDEX_FILE'], search_index.snapshot,
+                                           backups=0, dump=MessageIndex.dump)
+# save_users() зовется на каждом просмотре (last_seen): fsync и ротация копий — в фоне, не в запросе
+users_persister = SnapshotPersister('users', lambda: app.config['USERS_FILE'], snapshot_users)
+persisters = (rooms_persister, search_index_persister, users_persister)
+
+def flush_persisters():
+    for persister in persisters:
+        try:
+            persister.flush()
+        except Exception as e:
+            log.error("snapshot save failed: %s", e, extra={'snapshot': persister.name})
+
+# ----- Persistence helpers -----
+def save_rooms():
+    rooms_persister.request()
+    search_index_persister.request()
+
+def assign_message_seqs(room_info):
+    """Нумерует сообщения без seq (старые данные) и выставляет last_seq комнаты"""
+    last_seq = room_info.get('last_seq', 0)
+    for message in room_info['messages']:
+        if 'seq' not in message:
+            last_seq += 1
+            message['seq'] = last_seq
+        else:
+            last_seq = max(last_seq, message['seq'])
+    room_info['last_seq'] = last_seq
+
+def load_rooms():
+    global rooms
+    loaded = read_json_with_backups(app.config['STORAGE_FILE'])
+    if loaded is not None:
+        for code in loaded:
+            loaded[code]["members"] = 0
+            assign_message_seqs(loaded[code])
+            loaded[code]["messages"] = [Message.from_dict(m) for m in loaded[code]["messages"]]
+        with rooms_lock:
+            rooms = loaded
 
-load_rooms()
-load_users()
+def save_users():
+    users_persister.request()
+
+def load_users():
+    global users
+    users_loaded = read_json_with_backups(app.config['USERS_FILE'])
+    if users_loaded is None:
+        users = {}
+        return
+    for user_id, user_data in users_loaded.items():
+        if 'password_hash' in user_data and isinstance(user_data['password_hash'], str):
+            user_data['password_hash'] = base64.b64decode(user_data['password_hash'])
+        if user_data.get('avatar') == 'file':
+            avatar_path = os.path.join(app.config['AVATARS_ROOT'], f"{user_id}.png")
+            if os.path.exists(avatar_path):
+                with open(avatar_path, 'rb') as avatar_file:
+                    user_data['avatar'] = base64.b64encode(avatar_file.read()).decode('utf-8')
+            else:
+                user_data['avatar'] = default_avatar
+    users = users_loaded
+    log.info("users loaded", extra={'total': len(users)})
 
 # ----- Email validation -----
 def validate_email(email):
@@ -172,9 +1114,155 @@ def validate_password(password):
 def generate_verification_code():
     return str(random.randint(100000, 999999))
 
+# ----- Outbound mail -----
+# Без SMTP_HOST письма не отправляются, а пишутся в лог (режим разработки)
+SMTP_HOST = os.environ.get('SMTP_HOST', '')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', 587))
+SMTP_USER = os.environ.get('SMTP_USER', '')
+SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD', '')
+SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', '1') == '1'
+SMTP_TIMEOUT = 10
+SMTP_IDLE_TIMEOUT = 60
+MAIL_FROM = os.environ.get('MAIL_FROM', 'noreply@niktoonion.local')
+MAIL_BATCH_SIZE = 20
+MAIL_MAX_ATTEMPTS = 5
+MAIL_RETRY_BASE = 2.0
+MAIL_QUEUE_SIZE = 10000
+
+class Mailer:
+    """Очередь исходящих писем с одним переиспользуемым SMTP-соединением.
+
+    Запрос только кладет письмо в очередь; фоновый воркер отправляет их
+    пачками, повторяет неудачные с экспоненциальной задержкой и закрывает
+    соединение после SMTP_IDLE_TIMEOUT простоя.
+    """
+
+    def __init__(self, host=None, port=None):
+        self.host = SMTP_HOST if host is None else host
+        self.port = SMTP_PORT if port is None else port
+        self.queue = queue.Queue(maxsize=MAIL_QUEUE_SIZE)
+        self.metrics = Counter()
+        self._retries = []
+        self._retry_seq = 0
+        self._conn = None
+        self._last_used = 0.0
+
+    def enqueue(self, to, subject, body):
+        message = EmailMessage()
+        message['From'] = MAIL_FROM
+        message['To'] = to
+        message['Subject'] = subject
+        message.set_content(body)
+        try:
+            self.queue.put_nowait((message, 1))
+        except queue.Full:
+            self.metrics['dropped'] += 1
+            return False
+        self.metrics['enqueued'] += 1
+        return True
+
+    def _connection(self):
+        if self._conn is None:
+            conn = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+            if SMTP_STARTTLS:
+                conn.starttls()
+            if SMTP_USER:
+                conn.login(SMTP_USER, SMTP_PASSWORD)
+            self._conn = conn
+            self.metrics['connections'] += 1
+        return self._conn
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._conn = None
+
+    def _send(self, message):
+        if not self.host:
+            log.info("mail (no SMTP_HOST)", extra={'to': message['To'], 'subject': message['Subject'],
+                                                  'body': message.get_content()})
+            return
+        try:
+            self._connection().send_message(message)
+        except smtplib.SMTPServerDisconnected:
+            self._conn = None
+            self._connection().send_message(message)
+
+    def _schedule_retry(self, message, attempt, error):
+        if attempt >= MAIL_MAX_ATTEMPTS:
+            self.metrics['failed'] += 1
+            log.error("mail delivery failed: %s", error, extra={'to': message['To'], 'attempts': attempt})
+            return
+        self.metrics['retried'] += 1
+        self._retry_seq += 1
+        due = time.time() + MAIL_RETRY_BASE ** attempt
+        heapq.heappush(self._retries, (due, self._retry_seq, message, attempt + 1))
+
+    def _next_batch(self):
+        now = time.time()
+        batch = []
+        while self._retries and self._retries[0][0] <= now and len(batch) < MAIL_BATCH_SIZE:
+            _, _, message, attempt = heapq.heappop(self._retries)
+            batch.append((message, attempt))
+        timeout = SMTP_IDLE_TIMEOUT
+        if self._retries:
+            timeout = max(0.0, min(timeout, self._retries[0][0] - now))
+        if not batch:
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                return batch
+        while len(batch) < MAIL_BATCH_SIZE:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def deliver(self, batch):
+        started = time.perf_counter()
+        for message, attempt in batch:
+            try:
+                self._send(message)
+                self.metrics['sent'] += 1
+            except (smtplib.SMTPException, OSError) as e:
+                self._close()
+                self._schedule_retry(message, attempt, e)
+        self._last_used = time.time()
+        self.metrics['batches'] += 1
+        self.metrics['send_seconds'] += time.perf_counter() - started
+
+    def run(self):
+        while True:
+            batch = self._next_batch()
+            if batch:
+                try:
+                    self.deliver(batch)
+                except Exception:
+                    # Воркер один: если он умрет, очередь молча заполнится и письма начнут отбрасываться
+                    self.metrics['errors'] += 1
+                    log.exception("mail worker error")
+                    self._close()
+            elif time.time() - self._last_used >= SMTP_IDLE_TIMEOUT:
+                self._close()
+
+    def status(self):
+        return {
+            'smtp_host': self.host or None,
+            'queued': self.queue.qsize(),
+            'retry_pending': len(self._retries),
+            'connected': self._conn is not None,
+            'metrics': {k: round(v, 4) if isinstance(v, float) else v for k, v in self.metrics.items()}
+        }
+
+mailer = Mailer()
+
 def send_verification_email(email, code):
-    print(f"[EMAIL] Код подтверждения для {email}: {code}")
-    return True
+    return mailer.enqueue(email, "Код подтверждения NIKTOONION",
+                          f"Ваш код подтверждения: {code}\n\nКод действует {VERIFICATION_CODE_EXPIRY // 60} минут.")
 
 # ----- User management -----
 def create_user(email, username, password, avatar=None):
@@ -221,6 +1309,17 @@ def require_auth(f):
     decorated.__name__ = f.__name__
     return decorated
 
+def is_admin(user):
+    return bool(user) and (bool(user.get('is_admin')) or user.get('email') in ADMIN_EMAILS)
+
+def require_admin(f):
+    def decorated(*args, **kwargs):
+        if not is_admin(users.get(session.get('user_id'))):
+            return jsonify({'error': 'Forbidden'}), 403
+        return f(*args, **kwargs)
+    decorated.__name__ = f.__name__
+    return decorated
+
 # ----- Helpers -----
 def generate_room_code(length: int, existing_codes: list[str]) -> str:
     while True:
@@ -229,60 +1328,120 @@ def generate_room_code(length: int, existing_codes: list[str]) -> str:
         if code not in existing_codes:
             return code
 
-def process_avatar(file, crop_data=None):
-    if not file or file.filename == '':
-        print("No file provided for avatar processing")
+# ----- Avatars -----
+AVATAR_MIMETYPES = ('image/png', 'image/jpeg', 'image/gif')
+AVATAR_SIZE = 256
+AVATAR_SIZES = (24, 48, 96, AVATAR_SIZE)
+AVATAR_VARIANT_FORMAT = 'WEBP' if features.check('webp') else 'PNG'
+AVATAR_VARIANT_MIMETYPE = f"image/{AVATAR_VARIANT_FORMAT.lower()}"
+AVATAR_MAX_AGE = 365 * 24 * 60 * 60
+
+def parse_crop_data(crop_data):
+    if not crop_data:
         return None
-    
-    print(f"Processing avatar: {file.filename}, type: {file.mimetype}, size: {file.content_length}")
-    
-    if file.mimetype not in ['image/png', 'image/jpeg', 'image/gif']:
-        print(f"Unsupported file type: {file.mimetype}")
+    try:
+        crop = json.loads(crop_data)
+        box = (crop['x'], crop['y'], crop['x'] + crop['width'], crop['y'] + crop['height'])
+        if box[2] <= box[0] or box[3] <= box[1]:
+            return None
+        return box
+    except Exception as e:
+        log.info("avatar crop data error: %s", e)
         return None
-    
+
+def process_avatar(data, crop_data=None):
+    """Возвращает (PNG 256x256 в base64, {размер: байты варианта}) или None.
+
+    Для больших JPEG draft() декодирует сразу в уменьшенном масштабе,
+    а reduce() дешево ужимает картинку перед LANCZOS.
+    """
+    box = parse_crop_data(crop_data)
     try:
-        img = Image.open(file)
-        print(f"Image opened: {img.size}, mode: {img.mode}")
-        
-        if img.mode != 'RGB':
-            print(f"Converting image from {img.mode} to RGB")
-            img = img.convert('RGB')
-        
-        if crop_data:
-            try:
-                crop_data_dict = json.loads(crop_data)
-                print(f"Crop data: {crop_data_dict}")
-                x = crop_data_dict['x']
-                y = crop_data_dict['y'] 
-                width = crop_data_dict['width']
-                height = crop_data_dict['height']
-                img = img.crop((x, y, x + width, y + height))
-                print(f"Image cropped to: {img.size}")
-            except Exception as e:
-                print(f"Crop data error: {e}")
-        
-        print(f"Resizing image to 256x256")
-        img = ImageOps.fit(img, (256, 256), method=Image.Resampling.LANCZOS)
-        
-        buffer = BytesIO()
-        img.save(buffer, format="PNG", quality=95)
-        avatar_data = base64.b64encode(buffer.getvalue()).decode('utf-8')
-        print(f"Avatar processing successful, data length: {len(avatar_data)}")
-        return avatar_data
+        with timed('pil'):
+            img = Image.open(BytesIO(data))
+            original_width, original_height = img.size
+            if img.format == 'JPEG':
+                region_width = box[2] - box[0] if box else original_width
+                region_height = box[3] - box[1] if box else original_height
+                img.draft('RGB', (math.ceil(original_width * AVATAR_SIZE / region_width),
+                                  math.ceil(original_height * AVATAR_SIZE / region_height)))
+            scale = img.size[0] / original_width
+
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            if box:
+                img = img.crop(tuple(round(v * scale) for v in box))
+
+            factor = min(img.size) // (AVATAR_SIZE * 2)
+            if factor >= 2:
+                img = img.reduce(factor)
+            img = ImageOps.fit(img, (AVATAR_SIZE, AVATAR_SIZE), method=Image.Resampling.LANCZOS)
+
+            buffer = BytesIO()
+            img.save(buffer, format="PNG", optimize=True)
+            variants = {}
+            for size in AVATAR_SIZES:
+                variant = img if size == AVATAR_SIZE else img.resize((size, size), Image.Resampling.LANCZOS)
+                variant_buffer = BytesIO()
+                if AVATAR_VARIANT_FORMAT == 'WEBP':
+                    variant.save(variant_buffer, format='WEBP', quality=85, method=4)
+                else:
+                    variant.save(variant_buffer, format='PNG', optimize=True)
+                variants[size] = variant_buffer.getvalue()
+        return base64.b64encode(buffer.getvalue()).decode('utf-8'), variants
     except Exception as e:
-        print(f"Avatar processing error: {e}")
+        log.warning("avatar processing error: %s", e)
         return None
 
+def avatar_url(user, size=48):
+    return url_for('get_user_avatar', user_id=user['id'], size=size, v=user.get('avatar_version'))
+
+def avatar_variant_path(user_id, size):
+    return os.path.join(app.config['AVATARS_ROOT'], f"{user_id}_{size}.{AVATAR_VARIANT_FORMAT.lower()}")
+
+def save_avatar_variants(user_id, variants):
+    for size, data in variants.items():
+        with open(avatar_variant_path(user_id, size), 'wb') as f:
+            f.write(data)
+
+def update_avatar(user_id, data, crop_data=None):
+    """Фоновая задача: обрабатывает загруженный аватар и сохраняет все размеры"""
+    result = process_avatar(data, crop_data)
+    user = users.get(user_id)
+    if not result or not user:
+        log.info("avatar update failed", extra={'user_id': user_id})
+        return
+    avatar_data, variants = result
+    try:
+        save_avatar_variants(user_id, variants)
+    except OSError as e:
+        log.error("avatar variants save failed: %s", e)
+    user['avatar'] = avatar_data
+    user['avatar_version'] = int(time.time() * 1000)
+    save_avatar_to_file(user_id, avatar_data)
+    save_users()
+
+def backfill_avatar_variants():
+    """Создает размеры для аватаров, загруженных до появления вариантов"""
+    for user_id, user in list(users.items()):
+        avatar = user.get('avatar')
+        if not avatar or avatar == default_avatar or os.path.exists(avatar_variant_path(user_id, AVATAR_SIZES[0])):
+            continue
+        result = process_avatar(base64.b64decode(avatar))
+        if result:
+            save_avatar_variants(user_id, result[1])
+
 def create_thumbnail(file_path, filename):
     """Создает миниатюру для изображений и видео"""
     try:
-        thumb_path = os.path.join(THUMBNAILS_ROOT, f"thumb_{filename}")
+        thumb_path = os.path.join(app.config['THUMBNAILS_ROOT'], f"thumb_{filename}")
         
         # Для изображений
         if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-            img = Image.open(file_path)
-            img.thumbnail((400, 400), Image.Resampling.LANCZOS)
-            img.save(thumb_path, "JPEG", quality=60)
+            with timed('pil'):
+                img = Image.open(file_path)
+                img.thumbnail((400, 400), Image.Resampling.LANCZOS)
+                img.save(thumb_path, "JPEG", quality=60)
             return thumb_path
         
         # Для видео (требуется ffmpeg, но мы просто вернем оригинал если нет)
@@ -292,24 +1451,23 @@ def create_thumbnail(file_path, filename):
             return file_path
             
     except Exception as e:
-        print(f"Thumbnail creation error: {e}")
+        log.warning("thumbnail creation error: %s", e)
         return file_path
     
     return file_path
 
 def save_avatar_to_file(user_id, avatar_data):
     try:
-        avatar_path = os.path.join(AVATARS_ROOT, f"{user_id}.png")
+        avatar_path = os.path.join(app.config['AVATARS_ROOT'], f"{user_id}.png")
         with open(avatar_path, 'wb') as f:
             f.write(base64.b64decode(avatar_data))
-        print(f"Avatar saved to file: {avatar_path}")
         return True
     except Exception as e:
-        print(f"Error saving avatar to file: {e}")
+        log.error("avatar save failed: %s", e)
         return False
 
 def room_upload_dir(room_code: str) -> str:
-    d = os.path.join(UPLOAD_ROOT, room_code)
+    d = os.path.join(app.config['UPLOAD_ROOT'], room_code)
     os.makedirs(d, exist_ok=True)
     return d
 
@@ -319,6 +1477,310 @@ def safe_filename(name: str) -> str:
     ext = re.sub(r'[^A-Za-z0-9\.]+', '', ext)
     return base + ext
 
+# ----- Upload storage accounting -----
+class DiskUsage:
+    """Байты на диске по комнатам (файлы + миниатюры); обновляется при записи и удалении"""
+
+    def __init__(self):
+        self.rooms = {}
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def add(self, room_code, size):
+        with self._lock:
+            self.rooms[room_code] = self.rooms.get(room_code, 0) + size
+            self.total += size
+
+    def remove(self, room_code, size):
+        with self._lock:
+            remaining = self.rooms.get(room_code, 0) - size
+            if remaining > 0:
+                self.rooms[room_code] = remaining
+            else:
+                self.rooms.pop(room_code, None)
+            self.total = max(0, self.total - size)
+
+    def reset(self, per_room):
+        with self._lock:
+            self.rooms = {code: size for code, size in per_room.items() if size > 0}
+            self.total = sum(self.rooms.values())
+
+    def check(self, room_code, size):
+        if self.rooms.get(room_code, 0) + size > ROOM_DISK_QUOTA:
+            return 'Room storage quota exceeded'
+        if self.total + size > GLOBAL_DISK_QUOTA:
+            return 'Server storage quota exceeded'
+        return None
+
+disk_usage = DiskUsage()
+
+def thumbnail_path_for(name):
+    return os.path.join(app.config['THUMBNAILS_ROOT'], f"thumb_{name}")
+
+def remove_path(path):
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    except OSError:
+        return 0
+
+def waveform_path_for(name):
+    return os.path.join(app.config['THUMBNAILS_ROOT'], f"peaks_{name}.json")
+
+def sidecar_owner(entry_name):
+    """Имя загрузки, к которой относится файл из THUMBNAILS_ROOT, или None"""
+    if entry_name.startswith('thumb_'):
+        return entry_name[len('thumb_'):]
+    if entry_name.startswith('peaks_') and entry_name.endswith('.json'):
+        return entry_name[len('peaks_'):-len('.json')]
+    return None
+
+def remove_upload(room_code, name):
+    freed = remove_path(os.path.join(app.config['UPLOAD_ROOT'], room_code, name))
+    freed += remove_path(thumbnail_path_for(name))
+    freed += remove_path(waveform_path_for(name))
+    disk_usage.remove(room_code, freed)
+    return freed
+
+def referenced_uploads():
+    """{room_code: {имя файла}} для всех файлов, на которые ссылаются сообщения"""
+    referenced = {}
+    for code, info in list(rooms.items()):
+        names = {m.file.name for m in list(info.get('messages', [])) if m.file and m.file.name}
+        referenced[code] = names
+    return referenced
+
+def collect_upload_garbage(grace=UPLOAD_GC_GRACE, rebase=False):
+    """Сверяет UPLOAD_ROOT и THUMBNAILS_ROOT с сообщениями и удаляет сирот старше grace.
+    Счетчики disk_usage уменьшаются только на удаленное; rebase=True (при старте)
+    пересчитывает их целиком по результату обхода."""
+    cutoff = time.time() - grace
+    referenced = referenced_uploads()
+    owner = {name: code for code, names in referenced.items() for name in names}
+    usage = {}
+    located = {}
+    removed = 0
+
+    for room_entry in os.scandir(app.config['UPLOAD_ROOT']):
+        if not room_entry.is_dir():
+            continue
+        names = referenced.get(room_entry.name, set())
+        for entry in os.scandir(room_entry.path):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            located[entry.name] = room_entry.name
+            if entry.name not in names and stat.st_mtime < cutoff:
+                disk_usage.remove(room_entry.name, remove_path(entry.path))
+                removed += 1
+            else:
+                usage[room_entry.name] = usage.get(room_entry.name, 0) + stat.st_size
+        if room_entry.name not in rooms and not any(os.scandir(room_entry.path)):
+            try:
+                os.rmdir(room_entry.path)
+            except OSError:
+                pass
+
+    for entry in os.scandir(app.config['THUMBNAILS_ROOT']):
+        upload_name = sidecar_owner(entry.name)
+        if not entry.is_file() or upload_name is None:
+            continue
+        stat = entry.stat()
+        code = owner.get(upload_name)
+        if code is None and stat.st_mtime < cutoff:
+            disk_usage.remove(located.get(upload_name), remove_path(entry.path))
+            removed += 1
+        elif code is not None or upload_name in located:
+            code = code or located[upload_name]
+            usage[code] = usage.get(code, 0) + stat.st_size
+
+    if rebase:
+        disk_usage.reset(usage)
+    if removed:
+        log.info("upload gc", extra={'removed': removed, 'total_bytes': disk_usage.total})
+    return removed
+
+def upload_gc_worker(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            collect_upload_garbage()
+        except Exception as e:
+            log.error("upload gc failed: %s", e)
+
+# ----- Audio waveforms -----
+WAVEFORM_BUCKETS = 64
+WAVEFORM_CHUNK_FRAMES = 1 << 16
+WAVEFORM_ATTACH_WINDOW = 50
+
+def pcm_samples(frames, sampwidth):
+    """Сырые PCM-кадры WAV -> int32 (8 бит беззнаковые, 24 бит упакованы по 3 байта)"""
+    if sampwidth == 1:
+        return np.frombuffer(frames, dtype=np.uint8).astype(np.int32) - 128
+    if sampwidth == 2:
+        return np.frombuffer(frames, dtype='<i2').astype(np.int32)
+    if sampwidth == 3:
+        raw = np.frombuffer(frames, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        samples = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        return samples - ((samples & 0x800000) << 1)
+    if sampwidth == 4:
+        return np.frombuffer(frames, dtype='<i4')
+    raise ValueError(f"unsupported sample width {sampwidth}")
+
+def compute_waveform(path, buckets=WAVEFORM_BUCKETS):
+    """Пики WAV: плоский список [min0, max0, min1, max1, ...] в процентах от полной шкалы.
+    Файл читается кусками по WAVEFORM_CHUNK_FRAMES кадров, min/max корзины, разрезанной
+    границей куска, переносятся в следующий — память не зависит от длины записи."""
+    with wave.open(path, 'rb') as wav:
+        channels = wav.getnchannels()
+        width = wav.getsampwidth()
+        rate = wav.getframerate()
+        total = wav.getnframes()
+        if not total or not rate:
+            return None
+        per_bucket = -(-total // buckets)
+        full_scale = float(1 << (8 * width - 1))
+        mins = np.full(buckets, np.iinfo(np.int32).max, dtype=np.int32)
+        maxs = np.full(buckets, np.iinfo(np.int32).min, dtype=np.int32)
+        position = 0
+        while True:
+            frames = wav.readframes(WAVEFORM_CHUNK_FRAMES)
+            if not frames:
+                break
+            samples = pcm_samples(frames, width)
+            count = len(samples) // channels
+            if not count:
+                break
+            per_frame = samples[:count * channels].reshape(count, channels)
+            first = position // per_bucket
+            # Начала корзин внутри куска: первая может продолжать корзину из прошлого куска
+            starts = np.arange((first + 1) * per_bucket - position, count, per_bucket)
+            starts = np.concatenate(([0], starts))
+            touched = slice(first, first + len(starts))
+            mins[touched] = np.minimum(mins[touched], np.minimum.reduceat(per_frame.min(axis=1), starts))
+            maxs[touched] = np.maximum(maxs[touched], np.maximum.reduceat(per_frame.max(axis=1), starts))
+            position += count
+    used = -(-position // per_bucket)
+    if not used:
+        return None
+    pairs = np.stack([mins[:used], maxs[:used]], axis=1) / full_scale
+    peaks = np.clip(np.rint(pairs * 100), -100, 100).astype(np.int8).ravel()
+    return {'peaks': peaks.tolist(), 'duration': round(total / rate, 2)}
+
+def load_waveform(name):
+    if os.path.basename(name) != name:
+        return None
+    try:
+        with open(waveform_path_for(name), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def extract_waveform(room_code, name, path):
+    """Фоновая задача upload(): пишет sidecar с пиками и кладет их в upload_meta,
+    затем дописывает в сообщение, если оно уже отправлено (иначе их подхватит on_message)"""
+    try:
+        waveform = compute_waveform(path)
+    except (wave.Error, EOFError, ValueError, OSError) as e:
+        log.info("waveform skipped for %s: %s", name, e)
+        return
+    if not waveform:
+        return
+    sidecar = waveform_path_for(name)
+    atomic_write_json(sidecar, waveform)
+    disk_usage.add(room_code, os.path.getsize(sidecar))
+    upload_meta.set(f"{room_code}/{name}", waveform)
+
+    message = None
+    with rooms_lock:
+        info = rooms.get(room_code)
+        for m in reversed(info['messages'][-WAVEFORM_ATTACH_WINDOW:] if info else []):
+            if m.file and m.file.name == name:
+                m.file.peaks = waveform['peaks']
+                m.file.duration = waveform['duration']
+                message = m
+                break
+    if message is not None:
+        socketio.emit('file_meta', {'seq': message.seq, 'file': message.file.to_dict()}, room=room_code)
+        save_rooms()
+
+# ----- Image dimensions and blur placeholders -----
+BLURHASH_SAMPLE_SIZE = 32
+BLURHASH_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+MAX_PENDING_UPLOADS = 10000
+
+# Метаданные, посчитанные в upload(), до отправки сообщения с файлом; живут столько же, сколько сирота до GC
+upload_meta = TTLStore(UPLOAD_GC_GRACE, MAX_PENDING_UPLOADS)
+ttl_stores.append(upload_meta)
+
+def base83(value, length):
+    return ''.join(BLURHASH_ALPHABET[value // 83 ** (length - i - 1) % 83] for i in range(length))
+
+def srgb_to_linear(values):
+    v = values / 255.0
+    return np.where(v <= 0.04045, v / 12.92, ((v + 0.055) / 1.055) ** 2.4)
+
+def linear_to_srgb(value):
+    v = min(max(value, 0.0), 1.0)
+    if v <= 0.0031308:
+        return int(v * 12.92 * 255 + 0.5)
+    return int((1.055 * v ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+def blurhash_encode(pixels, components_x, components_y):
+    """BlurHash для массива (h, w, 3) uint8: DCT-коэффициенты одним einsum вместо циклов по пикселям"""
+    height, width = pixels.shape[:2]
+    linear = srgb_to_linear(pixels.astype(np.float64))
+    basis_x = np.cos(np.pi * np.outer(np.arange(components_x), np.arange(width)) / width)
+    basis_y = np.cos(np.pi * np.outer(np.arange(components_y), np.arange(height)) / height)
+    factors = np.einsum('jy,ix,yxc->jic', basis_y, basis_x, linear) / (width * height)
+    factors = factors.reshape(-1, 3)
+    factors[1:] *= 2
+
+    dc, ac = factors[0], factors[1:]
+    result = base83((components_x - 1) + (components_y - 1) * 9, 1)
+    if len(ac):
+        actual_max = float(np.abs(ac).max())
+        quantised_max = int(max(0, min(82, math.floor(actual_max * 166 - 0.5))))
+        max_value = (quantised_max + 1) / 166
+        result += base83(quantised_max, 1)
+    else:
+        max_value = 1
+        result += base83(0, 1)
+    r, g, b = (linear_to_srgb(c) for c in dc)
+    result += base83((r << 16) + (g << 8) + b, 4)
+    if len(ac):
+        scaled = ac / max_value
+        quant = np.clip(np.floor(np.sign(scaled) * np.sqrt(np.abs(scaled)) * 9 + 9.5), 0, 18).astype(int)
+        for qr, qg, qb in quant.tolist():
+            result += base83(qr * 19 * 19 + qg * 19 + qb, 2)
+    return result
+
+def image_info(file_path):
+    """Размеры с учетом EXIF-поворота, ориентация и BlurHash-плейсхолдер (если есть NumPy)"""
+    try:
+        with timed('pil'):
+            with Image.open(file_path) as img:
+                width, height = img.size
+                if img.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+                    width, height = height, width
+                info = {
+                    'width': width,
+                    'height': height,
+                    'orientation': 'landscape' if width > height else 'portrait' if height > width else 'square'
+                }
+                if np is None:
+                    return info
+                img.draft('RGB', (BLURHASH_SAMPLE_SIZE * 2, BLURHASH_SAMPLE_SIZE * 2))
+                small = ImageOps.exif_transpose(img).convert('RGB')
+                small.thumbnail((BLURHASH_SAMPLE_SIZE, BLURHASH_SAMPLE_SIZE), Image.Resampling.BILINEAR)
+        components = (4, 3) if width >= height else (3, 4)
+        info['placeholder'] = blurhash_encode(np.asarray(small), *components)
+        return info
+    except Exception as e:
+        log.warning("image info error: %s", e)
+        return None
+
 # ----- Time formatting helpers -----
 def time_ago(timestamp):
     now = time.time()
@@ -355,16 +1817,17 @@ def create_private_room(user1_id, user2_id):
         user1 = users.get(user1_id)
         user2 = users.get(user2_id)
         
-        rooms[room_id] = {
-            'members': 0,
-            'messages': [],
-            'public': False,
-            'private': True,
-            'participants': [user1_id, user2_id],
-            'title': f"Чат с {user2['display_name']}" if user1_id == user1_id else f"Чат с {user1['display_name']}",
-            'created_by': user1_id,
-            'created_at': time.time()
-        }
+        with rooms_lock:
+            rooms[room_id] = {
+                'members': 0,
+                'messages': [],
+                'public': False,
+                'private': True,
+                'participants': [user1_id, user2_id],
+                'title': f"Чат с {user2['display_name']}" if user1_id == user1_id else f"Чат с {user1['display_name']}",
+                'created_by': user1_id,
+                'created_at': time.time()
+            }
         save_rooms()
     
     return room_id
@@ -380,8 +1843,9 @@ def auth_required():
         if not validated_email:
             return render_template('auth.html', error="Неверный формат email. Пример: user@example.com")
         
-        if validated_email in verification_codes:
-            last_sent = verification_codes[validated_email].get('timestamp', 0)
+        pending = verification_codes.get(validated_email)
+        if pending:
+            last_sent = pending.get('timestamp', 0)
             if time.time() - last_sent < 60:
                 return render_template('auth.html', error="Подождите 60 секунд перед отправкой нового кода")
         
@@ -428,17 +1892,16 @@ def verify_code():
         if password != password_confirm:
             return render_template('verify.html', error="Пароли не совпадают")
         
-        if pending_email not in verification_codes:
+        verification_data = verification_codes.get(pending_email)
+        if not verification_data:
             return render_template('verify.html', error="Код устарел, запросите новый")
         
-        verification_data = verification_codes[pending_email]
-        
         if verification_data['attempts'] >= 5:
-            del verification_codes[pending_email]
+            verification_codes.pop(pending_email)
             return render_template('verify.html', error="Слишком много попыток, запросите новый код")
         
         if time.time() - verification_data['timestamp'] > VERIFICATION_CODE_EXPIRY:
-            del verification_codes[pending_email]
+            verification_codes.pop(pending_email)
             return render_template('verify.html', error="Код устарел, запросите новый")
         
         if code != verification_data['code']:
@@ -454,7 +1917,7 @@ def verify_code():
         session['user_id'] = user['id']
         session['username'] = user['username']
         
-        del verification_codes[pending_email]
+        verification_codes.pop(pending_email)
         session.pop('pending_email', None)
         
         return redirect(url_for('home'))
@@ -478,8 +1941,7 @@ def login():
         if not verify_password(user.get('password_hash', b''), password):
             return render_template('login.html', error="Неверный пароль")
         
-        print(f"Login successful for user: {user['username']}")
-        print(f"User avatar length: {len(user.get('avatar', ''))}")
+        log.info("login", extra={'user_id': user['id']})
         
         session['user_id'] = user['id']
         session['username'] = user['username']
@@ -536,12 +1998,6 @@ def profile():
         avatar_file = request.files.get('avatar')
         crop_data = request.form.get('crop_data')
         
-        print(f"Profile update for user {user_id}:")
-        print(f"Display name: {display_name}")
-        print(f"Bio: {bio}")
-        print(f"Avatar file: {avatar_file}")
-        print(f"Crop data: {crop_data}")
-        
         if display_name:
             user['display_name'] = display_name
             session['username'] = display_name
@@ -550,19 +2006,12 @@ def profile():
             user['bio'] = bio
             
         if avatar_file and avatar_file.filename:
-            print(f"Processing avatar file: {avatar_file.filename}")
-            new_avatar = process_avatar(avatar_file, crop_data)
-            if new_avatar:
-                user['avatar'] = new_avatar
-                save_avatar_to_file(user_id, new_avatar)
-                print(f"Avatar updated successfully for user {user_id}")
+            if avatar_file.mimetype in AVATAR_MIMETYPES:
+                socketio.start_background_task(update_avatar, user_id, avatar_file.read(), crop_data)
             else:
-                print(f"Avatar processing failed for user {user_id}")
-        else:
-            print("No avatar file provided")
+                log.info("avatar rejected", extra={'mimetype': avatar_file.mimetype})
         
         save_users()
-        print("User data saved successfully")
         return redirect(url_for('profile'))
     
     return render_template('profile.html', user=user)
@@ -594,14 +2043,15 @@ def home():
 
         if create or not (join or create):
             room_code = generate_room_code(16, list(rooms.keys()))
-            rooms[room_code] = {
-                'members': 0,
-                'messages': [],
-                'public': is_public,
-                'title': title or f'Room {room_code}',
-                'created_by': session['user_id'],
-                'created_at': time.time()
-            }
+            with rooms_lock:
+                rooms[room_code] = {
+                    'members': 0,
+                    'messages': [],
+                    'public': is_public,
+                    'title': title or f'Room {room_code}',
+                    'created_by': session['user_id'],
+                    'created_at': time.time()
+                }
             session['room'] = room_code
             save_rooms()
             return redirect(url_for('room'))
@@ -631,14 +2081,18 @@ def room():
         return redirect(url_for('home'))
     
     update_user_last_seen(user_id)
-    messages = rooms[room_code]['messages']
+    mark_room_read(room_code, user_id)
+    messages = [m.to_dict() for m in rooms[room_code]['messages']]
     user = users[user_id]
+    # Версии аватаров авторов: клиент запрашивает /avatar?v=..., который кэшируется как immutable
+    avatar_versions = {uid: users[uid].get('avatar_version') for uid in {m.get('user_id') for m in messages} if uid in users}
     
     return render_template(
         'room.html',
         room=room_code,
         title=rooms[room_code].get('title'),
         messages=messages,
+        avatar_versions=avatar_versions,
         user=user,
         default_avatar=default_avatar,
     )
@@ -652,13 +2106,10 @@ def delete_message():
     message_index = request.json.get('message_index')
     message_timestamp = request.json.get('timestamp')
     
-    print(f"Delete message request: room={room_code}, index={message_index}, user={user_id}")
-    
     if not room_code or message_index is None or not message_timestamp:
         return jsonify({'success': False, 'error': 'Missing parameters'})
     
     if room_code not in rooms:
-        print(f"Room not found: {room_code}")
         return jsonify({'success': False, 'error': 'Room not found'})
     
     room_data = rooms[room_code]
@@ -682,21 +2133,15 @@ def delete_message():
         return jsonify({'success': False, 'error': 'Message timestamp mismatch'})
     
     # Удаляем сообщение
-    deleted_message = room_data['messages'].pop(message_index)
+    with rooms_lock:
+        deleted_message = room_data['messages'].pop(message_index)
+    search_index.remove(room_code, deleted_message)
+    memory_stats.remove(room_code, deleted_message)
+    read_state.on_delete(room_code, deleted_message, unread_readers(room_data, room_code))
     
-    # Если в сообщении были файлы, удаляем их с диска
-    if deleted_message.get('file'):
-        try:
-            file_path = os.path.join(UPLOAD_ROOT, room_code, deleted_message['file']['name'])
-            if os.path.exists(file_path):
-                os.remove(file_path)
-            
-            # Удаляем миниатюру если есть
-            thumb_path = os.path.join(THUMBNAILS_ROOT, f"thumb_{deleted_message['file']['name']}")
-            if os.path.exists(thumb_path):
-                os.remove(thumb_path)
-        except Exception as e:
-            print(f"Error deleting file: {e}")
+    # Если в сообщении были файлы, удаляем их и миниатюру с диска
+    if deleted_message.get('file') and deleted_message['file'].get('name'):
+        remove_upload(room_code, deleted_message['file']['name'])
     
     save_rooms()
     
@@ -746,12 +2191,52 @@ def get_user_avatar(user_id):
     if not user:
         return "User not found", 404
     
+    size = request.args.get('size', type=int)
+    if size:
+        variant = next((s for s in AVATAR_SIZES if s >= size), AVATAR_SIZE)
+        variant_path = avatar_variant_path(user_id, variant)
+        if os.path.exists(variant_path):
+            response = send_file(variant_path, mimetype=AVATAR_VARIANT_MIMETYPE)
+            if request.args.get('v') == str(user.get('avatar_version')):
+                response.headers['Cache-Control'] = f'public, max-age={AVATAR_MAX_AGE}, immutable'
+            else:
+                response.headers['Cache-Control'] = 'public, max-age=300'
+            return response
+    
     avatar_data = user.get('avatar', default_avatar)
     try:
         return send_file(BytesIO(base64.b64decode(avatar_data)), mimetype='image/png')
     except:
         return send_file(BytesIO(base64.b64decode(default_avatar)), mimetype='image/png')
 
+# ----- Batch user lookup -----
+USERS_BATCH_LIMIT = 200
+
+@app.get('/api/users')
+@require_auth
+def api_users_batch():
+    """Профили и онлайн-статус пачкой: /api/users?ids=a,b,c&size=48.
+    Ответ с ETag — клиент перепроверяет весь список одним запросом; last_seen
+    меняется на каждом просмотре, поэтому в ответ не входит."""
+    ids = [uid for uid in request.args.get('ids', '').split(',') if uid][:USERS_BATCH_LIMIT]
+    size = request.args.get('size', 48, type=int)
+    result = {}
+    for user_id in dict.fromkeys(ids):
+        user = users.get(user_id)
+        if not user:
+            continue
+        result[user_id] = {
+            'display_name': user.get('display_name'),
+            'username': user.get('username'),
+            'avatar_url': avatar_url(user, size),
+            'avatar_version': user.get('avatar_version'),
+            'online': user_id in online_users
+        }
+    response = jsonify({'users': result})
+    response.add_etag()
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
 # ----- Notifications and Recent Chats -----
 @app.route('/api/notifications')
 @require_auth
@@ -761,10 +2246,10 @@ def get_notifications():
     
     for room_code, room_info in rooms.items():
         if room_info.get('private') and user_id in room_info.get('participants', []):
-            if room_info['messages']:
+            unread_count = read_state.unread(user_id, room_code)
+            if unread_count and room_info['messages']:
                 last_message = room_info['messages'][-1]
-                if (last_message.get('user_id') != user_id and 
-                    last_message.get('timestamp', 0) > users[user_id].get('last_notification_check', 0)):
+                if last_message.get('user_id') != user_id:
                     
                     other_user_id = [uid for uid in room_info['participants'] if uid != user_id][0]
                     other_user = users.get(other_user_id)
@@ -776,7 +2261,8 @@ def get_notifications():
                             'from_user_id': other_user_id,
                             'room_id': room_code,
                             'preview': last_message.get('message', '')[:100],
-                            'timestamp': last_message.get('timestamp', time.time())
+                            'timestamp': last_message.get('timestamp', time.time()),
+                            'unread_count': unread_count
                         })
     
     return jsonify({'notifications': notifications})
@@ -794,14 +2280,17 @@ def get_recent_chats():
             
             if other_user:
                 last_message = room_info['messages'][-1] if room_info['messages'] else None
+                unread_count = read_state.unread(user_id, room_code)
                 
                 chat_data = {
                     'user_id': other_user_id,
                     'display_name': other_user['display_name'],
                     'username': other_user['username'],
-                    'avatar': other_user['avatar'],
+                    'avatar_url': avatar_url(other_user, 96),
+                    'online': other_user_id in online_users,
                     'room_id': room_code,
-                    'unread': False
+                    'unread': unread_count > 0,
+                    'unread_count': unread_count
                 }
                 
                 if last_message:
@@ -820,6 +2309,17 @@ def get_recent_chats():
     recent_chats.sort(key=lambda x: x['timestamp'], reverse=True)
     return jsonify({'chats': recent_chats})
 
+@app.post('/api/rooms/<code>/read')
+@require_auth
+def api_mark_room_read(code):
+    if code not in rooms:
+        return jsonify({'error': 'Room not found'}), 404
+    if not is_room_reader(rooms[code], session['user_id']):
+        return jsonify({'error': 'Forbidden'}), 403
+    timestamp = (request.get_json(silent=True) or {}).get('timestamp')
+    mark_room_read(code, session['user_id'], timestamp if isinstance(timestamp, (int, float)) else None)
+    return jsonify({'unread': read_state.unread(session['user_id'], code)})
+
 @app.route('/notifications')
 @require_auth
 def notifications_page():
@@ -873,6 +2373,62 @@ def api_search_rooms():
     
     return {'rooms': results[:10]}  # Ограничиваем результаты
 
+# ----- Message search API -----
+def user_rooms(user_id):
+    """Комнаты пользователя: личные чаты, созданные им и те, где он писал"""
+    for code, info in rooms.items():
+        if info.get('private'):
+            if user_id in info.get('participants', []):
+                yield code
+        elif info.get('created_by') == user_id or search_index.has_author(code, user_id):
+            yield code
+
+def can_search_room(user_id, room_code):
+    info = rooms.get(room_code)
+    if not info:
+        return False
+    if info.get('private'):
+        return user_id in info.get('participants', [])
+    return (info.get('public') or session.get('room') == room_code or
+            info.get('created_by') == user_id or search_index.has_author(room_code, user_id))
+
+def search_messages_response(room_codes, query):
+    try:
+        page = max(1, int(request.args.get('page', 1)))
+        per_page = min(max(1, int(request.args.get('per_page', 20))), SEARCH_MAX_PER_PAGE)
+    except ValueError:
+        return jsonify({'error': 'Invalid pagination'}), 400
+
+    hits = search_index.search(room_codes, query)
+    results = []
+    for score, timestamp, room_code in hits[(page - 1) * per_page:page * per_page]:
+        index, message = find_message(room_code, timestamp)
+        if message is None:
+            continue
+        results.append({
+            'room_code': room_code,
+            'room_title': rooms[room_code].get('title') or f'Room {room_code}',
+            'message_index': index,
+            'sender': message.get('sender'),
+            'user_id': message.get('user_id'),
+            'message': message.get('message', ''),
+            'timestamp': message.get('timestamp'),
+            'score': round(score, 4)
+        })
+    return jsonify({'query': query, 'results': results, 'total': len(hits), 'page': page, 'per_page': per_page})
+
+@app.get('/api/rooms/<code>/search')
+@require_auth
+def api_search_room_messages(code):
+    if not can_search_room(session['user_id'], code):
+        return jsonify({'error': 'Room not found'}), 404
+    return search_messages_response([code], request.args.get('q', '').strip())
+
+@app.get('/api/search-messages')
+@require_auth
+def api_search_messages():
+    return search_messages_response(list(user_rooms(session['user_id'])), request.args.get('q', '').strip())
+
 # ----- Media upload -----
 @app.post('/upload')
 @require_auth
@@ -897,6 +2453,10 @@ def upload():
     if file_length > MAX_UPLOAD_SIZE:
         return jsonify({'error': 'File too large'}), 400
 
+    quota_error = disk_usage.check(room_code, file_length)
+    if quota_error:
+        return jsonify({'error': quota_error}), 413
+
     filename = safe_filename(file.filename)
     mimetype = file.mimetype or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
     rdir = room_upload_dir(room_code)
@@ -906,6 +2466,9 @@ def upload():
 
     # Создаем миниатюру для изображений
     thumbnail_path = create_thumbnail(path, unique)
+    disk_usage.add(room_code, file_length)
+    if thumbnail_path != path and os.path.exists(thumbnail_path):
+        disk_usage.add(room_code, os.path.getsize(thumbnail_path))
 
     url = url_for('media', room=room_code, filename=unique)
     thumb_url = url_for('media', room=room_code, filename=unique)  # Пока используем тот же URL
@@ -915,58 +2478,76 @@ def upload():
         return jsonify(meta)
     elif mimetype.startswith('image/'):
         meta = {'kind': 'image', 'name': unique, 'type': mimetype, 'url': url, 'thumb_url': thumb_url}
+        info = image_info(path)
+        if info:
+            # Клиенту — сразу для превью; в сообщение on_message берет серверную копию, а не присланную
+            upload_meta.set(f"{room_code}/{unique}", info)
+            meta.update(info)
         return jsonify(meta)
     elif mimetype.startswith('audio/'):
+        # Пики считаем в фоне; к сообщению их добавит сервер, клиенту качать аудио не нужно
+        if np is not None and unique.lower().endswith('.wav'):
+            socketio.start_background_task(extract_waveform, room_code, unique, path)
         return jsonify({'kind': 'audio', 'name': unique, 'type': mimetype, 'url': url})
     else:
         return jsonify({'kind': 'file', 'name': unique, 'type': mimetype, 'url': url})
 
 # ----- Enhanced Media streaming -----
+def is_within(root, path):
+    root = os.path.realpath(root)
+    return os.path.commonpath([root, os.path.realpath(path)]) == root
+
+MEDIA_MAX_AGE = 365 * 24 * 60 * 60
+
+def offload_media(file_path, ctype, root, prefix):
+    """Ответ без тела: файл отдает фронтовой прокси по X-Accel-Redirect / X-Sendfile"""
+    response = Response(mimetype=ctype)
+    if app.config['MEDIA_OFFLOAD'] == 'nginx':
+        relative = os.path.relpath(os.path.realpath(file_path), os.path.realpath(root)).replace(os.sep, '/')
+        response.headers['X-Accel-Redirect'] = prefix + quote(relative)
+    else:
+        response.headers['X-Sendfile'] = os.path.realpath(file_path)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Cache-Control'] = f'public, max-age={MEDIA_MAX_AGE}, immutable'
+    return response
+
+def media_etag(file_path):
+    """Сильный ETag из inode/mtime/размера — без чтения содержимого"""
+    st = os.stat(file_path)
+    return f"{st.st_ino:x}-{st.st_mtime_ns:x}-{st.st_size:x}"
+
 @app.route("/media/<room>/<path:filename>")
 def media(room, filename):
-    room_path = os.path.join(UPLOAD_ROOT, room)
+    if room not in rooms:
+        return "Not found", 404
+    room_path = os.path.join(app.config['UPLOAD_ROOT'], room)
     file_path = os.path.join(room_path, filename)
+    allowed_dir = room_path
+    root, prefix = app.config['UPLOAD_ROOT'], app.config['MEDIA_ACCEL_UPLOADS_PREFIX']
     
     # Проверяем, запрашивается ли миниатюра
     thumb_request = request.args.get('thumb')
     if thumb_request and filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-        thumb_path = os.path.join(THUMBNAILS_ROOT, f"thumb_{filename}")
+        thumb_path = os.path.join(app.config['THUMBNAILS_ROOT'], f"thumb_{filename}")
         if os.path.exists(thumb_path):
             file_path = thumb_path
+            allowed_dir = app.config['THUMBNAILS_ROOT']
+            root, prefix = app.config['THUMBNAILS_ROOT'], app.config['MEDIA_ACCEL_THUMBNAILS_PREFIX']
     
-    if not os.path.isfile(file_path):
+    if not is_within(allowed_dir, file_path) or not os.path.isfile(file_path):
         return "Not found", 404
 
     ctype = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
-    file_size = os.path.getsize(file_path)
-
-    range_header = request.headers.get('Range')
-    
-    if range_header and ctype.startswith('video/'):
-        byte1, byte2 = 0, None
-        match = re.match(r'bytes=(\d+)-(\d*)', range_header)
-        if match:
-            g1, g2 = match.groups()
-            byte1 = int(g1) if g1 else 0
-            byte2 = int(g2) if g2 and g2.isdigit() else file_size - 1
-        
-        content_length = byte2 - byte1 + 1 if byte2 else file_size - byte1
-        
-        with open(file_path, 'rb') as f:
-            f.seek(byte1)
-            data = f.read(content_length)
-
-        response = Response(data, 206, mimetype=ctype, direct_passthrough=True)
-        response.headers.add('Content-Range', f'bytes {byte1}-{byte1 + content_length - 1}/{file_size}')
-        response.headers.add('Accept-Ranges', 'bytes')
-        response.headers.add('Content-Length', str(content_length))
-        response.headers.add('Cache-Control', 'no-cache')
-        return response
-    else:
-        response = send_file(file_path, mimetype=ctype)
-        response.headers.add('Accept-Ranges', 'bytes')
-        response.headers.add('Cache-Control', 'public, max-age=3600')
-        return response
+    if app.config['MEDIA_OFFLOAD']:
+        return offload_media(file_path, ctype, root, prefix)
+
+    # Имена загрузок уникальны и не меняются: отдаем как immutable, а
+    # If-None-Match / If-Range / Range (206, 304, 416) обрабатывает send_file
+    response = send_file(file_path, mimetype=ctype, conditional=True,
+                         etag=media_etag(file_path), max_age=MEDIA_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 # ----- Error handler -----
 @app.route('/error')
@@ -975,8 +2556,33 @@ def error_page():
     return render_template('error.html', error=error_msg)
 
 # ----- Socket handlers -----
+# ----- Reconnect resume -----
+RESUME_WINDOW = 200
+
+def missed_messages(room_code, last_seq):
+    """Сообщения после last_seq из последних RESUME_WINDOW, или None, если клиент отстал сильнее"""
+    with rooms_lock:
+        messages = rooms[room_code]['messages']
+        if len(messages) > RESUME_WINDOW and (messages[-RESUME_WINDOW - 1].get('seq') or 0) > last_seq:
+            return None
+        window = messages[-RESUME_WINDOW:]
+        start = bisect.bisect_right(window, last_seq, key=lambda m: m.get('seq') or 0)
+        missed = window[start:]
+    return [m.to_dict() for m in missed]
+
+def resume_client(room_code, last_seq):
+    missed = missed_messages(room_code, last_seq)
+    last = rooms[room_code].get('last_seq', 0)
+    if missed is None:
+        emit('resume', {'too_far_behind': True, 'last_seq': last})
+    else:
+        emit('resume', {'messages': missed, 'last_seq': last})
+
 @socketio.on('connect')
-def on_connect():
+@timed_event('connect')
+def on_connect(auth=None):
+    if not data_ready.is_set():
+        return False
     user_id = session.get('user_id')
     if not user_id or user_id not in users:
         return False
@@ -985,8 +2591,19 @@ def on_connect():
     if not room_code:
         return
     
+    if room_code not in rooms:
+        return False
+    
     user = users[user_id]
-    join_room(room_code)
+    last_seq = auth.get('last_seq') if isinstance(auth, dict) else None
+    # on_message нумерует и рассылает под rooms_lock: вход в комнату и досылка под ним же,
+    # чтобы живое сообщение не обогнало resume
+    with rooms_lock:
+        join_room(room_code)
+        if isinstance(last_seq, int) and not isinstance(last_seq, bool):
+            resume_client(room_code, last_seq)
+    presence_join(room_code, user_id)
+    mark_room_read(room_code, user_id)
     rooms[room_code]['members'] = rooms[room_code].get('members', 0) + 1
     
     msg = {
@@ -998,6 +2615,7 @@ def on_connect():
     send(msg, room=room_code)
 
 @socketio.on('message')
+@timed_event('message')
 def on_message(data):
     user_id = session.get('user_id')
     if not user_id or user_id not in users:
@@ -1016,7 +2634,8 @@ def on_message(data):
     content = {
         "sender": user.get('display_name', user.get('username', 'User')),
         "message": message_text,
-        "avatar": user.get('avatar'),
+        "avatar": None,
+        "avatar_version": user.get('avatar_version'),
         "user_id": user_id,
         "timestamp": time.time()
     }
@@ -1033,27 +2652,63 @@ def on_message(data):
     if not content['message'] and not content.get('file'):
         return
 
-    send(content, room=room_code)
-    rooms[room_code]['messages'].append(content)
+    upload_key = None
+    if content.get('file') and content['file']['name']:
+        upload_key = f"{room_code}/{content['file']['name']}"
+        info = upload_meta.get(upload_key)
+        if info:
+            content['file'].update(info)
+        elif content['file']['kind'] == 'audio':
+            # После перезапуска upload_meta пуст — пики есть только в sidecar
+            info = load_waveform(content['file']['name'])
+            if info:
+                content['file'].update(peaks=info.get('peaks'), duration=info.get('duration'))
+
+    with rooms_lock:
+        # extract_waveform кладет пики в upload_meta до того, как взять этот лок, и ищет сообщение под ним:
+        # либо пики видны здесь, либо задача найдет уже добавленное сообщение
+        if upload_key and content['file']['kind'] == 'audio' and 'peaks' not in content['file']:
+            info = upload_meta.get(upload_key)
+            if info:
+                content['file'].update(info)
+        room_info = rooms[room_code]
+        content['seq'] = room_info.get('last_seq', 0) + 1
+        room_info['last_seq'] = content['seq']
+        message = Message.from_dict(content)
+        room_info['messages'].append(message)
+        # Рассылка под локом: клиенты получают сообщения в порядке seq
+        send(content, room=room_code)
+    search_index.add(room_code, content)
+    memory_stats.add(room_code, message)
+    read_state.on_message(room_code, content, unread_readers(rooms[room_code], room_code, user_id))
     save_rooms()
 
 @socketio.on('message_deleted')
+@timed_event('message_deleted')
 def on_message_deleted(data):
     room_code = data.get('room_code')
     message_index = data.get('message_index')
     
     if room_code in rooms and 0 <= message_index < len(rooms[room_code]['messages']):
         # Обновляем сообщение в комнате
-        rooms[room_code]['messages'][message_index] = {
-            "sender": "System",
-            "message": "Сообщение было удалено",
-            "avatar": None,
-            "timestamp": time.time(),
-            "deleted": True
-        }
+        removed = rooms[room_code]['messages'][message_index]
+        search_index.remove(room_code, removed)
+        read_state.on_delete(room_code, removed, unread_readers(rooms[room_code], room_code))
+        placeholder = Message(
+            sender="System",
+            message="Сообщение было удалено",
+            timestamp=time.time(),
+            deleted=True,
+            seq=removed.get('seq')
+        )
+        with rooms_lock:
+            rooms[room_code]['messages'][message_index] = placeholder
+        memory_stats.remove(room_code, removed)
+        memory_stats.add(room_code, placeholder)
         save_rooms()
 
 @socketio.on('disconnect')
+@timed_event('disconnect')
 def on_disconnect():
     user_id = session.get('user_id')
     if not user_id:
@@ -1066,7 +2721,9 @@ def on_disconnect():
         return
         
     leave_room(room_code)
+    presence_leave(room_code, user_id)
     if room_code in rooms:
+        mark_room_read(room_code, user_id)
         rooms[room_code]['members'] = max(0, rooms[room_code].get('members', 0) - 1)
         msg = {
             "sender": "System", 
@@ -1077,7 +2734,11 @@ def on_disconnect():
         send(msg, room=room_code)
         if rooms[room_code]['members'] <= 0 and not rooms[room_code].get('private'):
             if not rooms[room_code].get('public'):
-                del rooms[room_code]
+                with rooms_lock:
+                    rooms.pop(room_code, None)
+                search_index.drop_room(room_code)
+                read_state.drop_room(room_code)
+                memory_stats.drop_room(room_code)
                 save_rooms()
 
 @app.template_filter('datetime')
@@ -1135,6 +2796,16 @@ def direct_message(user_id):
     session['room'] = room_id
     return redirect(url_for('room'))
 
+# ----- Request timing -----
+@app.before_request
+def start_request_timing():
+    begin_timing()
+
+@app.after_request
+def record_request_timing(response):
+    end_timing('route', request.endpoint or request.path)
+    return response
+
 # ----- Security headers -----
 @app.after_request
 def set_security_headers(response):
@@ -1143,6 +2814,158 @@ def set_security_headers(response):
     response.headers['X-XSS-Protection'] = '1; mode=block'
     return response
 
+# ----- Fingerprinted static assets -----
+STATIC_ASSET_MAX_AGE = 365 * 24 * 60 * 60
+
+asset_names = {}
+asset_sources = {}
+
+def fingerprint_static():
+    """Хэширует файлы статики: url_for('static', filename='room.js') -> /static/room.<hash>.js"""
+    asset_names.clear()
+    asset_sources.clear()
+    for root, _, files in os.walk(app.static_folder):
+        for name in files:
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()[:12]
+            filename = os.path.relpath(path, app.static_folder).replace(os.sep, '/')
+            base, ext = os.path.splitext(filename)
+            fingerprinted = f"{base}.{digest}{ext}"
+            asset_names[filename] = fingerprinted
+            asset_sources[fingerprinted] = filename
+
+@app.url_defaults
+def fingerprint_static_url(endpoint, values):
+    if endpoint == 'static' and values.get('filename') in asset_names:
+        values['filename'] = asset_names[values['filename']]
+
+def serve_static(filename):
+    source = asset_sources.get(filename)
+    if source is None:
+        return app.send_static_file(filename)
+    response = app.send_static_file(source)
+    response.headers['Cache-Control'] = f'public, max-age={STATIC_ASSET_MAX_AGE}, immutable'
+    return response
+
+app.view_functions['static'] = serve_static
+
+# ----- Compression -----
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_GZIP_LEVEL = 6
+COMPRESS_BROTLI_QUALITY = 5
+COMPRESSIBLE_MIMETYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/javascript',
+    'application/javascript', 'application/json', 'image/svg+xml'
+}
+STATIC_PRECOMPRESS_EXTENSIONS = ('.css', '.js', '.svg', '.json', '.txt', '.html')
+
+static_compressed = {}
+
+def available_encodings():
+    return ['br', 'gzip'] if brotli else ['gzip']
+
+def compress_bytes(data, encoding, best=False):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if best else COMPRESS_BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=9 if best else COMPRESS_GZIP_LEVEL, mtime=0)
+
+def precompress_static():
+    """Один раз сжимает статику при старте; ответы static берутся из этого кэша"""
+    static_compressed.clear()
+    for root, _, files in os.walk(app.static_folder):
+        for name in files:
+            if not name.endswith(STATIC_PRECOMPRESS_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            if len(data) < COMPRESS_MIN_SIZE:
+                continue
+            filename = os.path.relpath(path, app.static_folder).replace(os.sep, '/')
+            for encoding in available_encodings():
+                compressed = compress_bytes(data, encoding, best=True)
+                if len(compressed) < len(data):
+                    static_compressed[(filename, encoding)] = compressed
+    log.info("static precompressed", extra={'entries': len(static_compressed)})
+
+@app.after_request
+def compress_response(response):
+    if (response.status_code != 200
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(available_encodings())
+    if not encoding:
+        return response
+
+    if request.endpoint == 'static':
+        filename = (request.view_args or {}).get('filename')
+        data = static_compressed.get((asset_sources.get(filename, filename), encoding))
+        if data is None:
+            return response
+        if hasattr(response.response, 'close'):
+            response.response.close()
+        response.direct_passthrough = False
+        response.set_data(data)
+        etag, _ = response.get_etag()
+        if etag:
+            response.set_etag(f"{etag}-{encoding}")
+        response.headers['Content-Encoding'] = encoding
+        return response.make_conditional(request)
+
+    if response.direct_passthrough or response.is_streamed:
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+    response.set_data(compress_bytes(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    # Сжатое представление — другие байты: строгий ETag не должен совпадать с несжатым
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(f"{etag}-{encoding}")
+        return response.make_conditional(request)
+    return response
+
+# ----- Admin: profiler and slow log -----
+@app.post('/admin/profiler/start')
+@require_admin
+def admin_profiler_start():
+    try:
+        duration = float(request.values.get('seconds', 30))
+    except ValueError:
+        return jsonify({'error': 'Invalid duration'}), 400
+    duration = max(1.0, min(duration, PROFILER_MAX_DURATION))
+    if not profiler.start(duration):
+        return jsonify({'error': 'Profiler already running', **profiler.status()}), 409
+    return jsonify(profiler.status())
+
+@app.post('/admin/profiler/stop')
+@require_admin
+def admin_profiler_stop():
+    profiler.stop()
+    return jsonify(profiler.status())
+
+@app.get('/admin/profiler')
+@require_admin
+def admin_profiler_status():
+    return jsonify(profiler.status())
+
+@app.get('/admin/profiler/folded')
+@require_admin
+def admin_profiler_folded():
+    response = Response(profiler.folded(), mimetype='text/plain')
+    response.headers['Content-Disposition'] = 'attachment; filename=profile.folded'
+    return response
+
+@app.get('/admin/slow-log')
+@require_admin
+def admin_slow_log():
+    return jsonify({'threshold': SLOW_REQUEST_THRESHOLD, 'entries': list(slow_log)})
+
 @app.get('/api/check-room')
 def api_check_room():
     code = request.args.get('code', '').strip()
@@ -1150,13 +2973,175 @@ def api_check_room():
         return jsonify({'exists': False})
     
     exists = code in rooms
-    print(f"Room check: {code} -> {exists}")
+    log.debug("room check", extra={'code': code, 'exists': exists, 'sample_rate': ROOM_CHECK_LOG_SAMPLE_RATE})
     return jsonify({'exists': exists})
 
-
-
-
+# ----- Application factory -----
+DATA_LOAD_MODES = ('eager', 'lazy', 'background')
+
+startup_metrics = {}
+data_ready = threading.Event()
+app_configured = threading.Event()
+_data_lock = threading.Lock()
+_setup_lock = threading.Lock()
+_background_started = False
+
+def load_data():
+    with _data_lock:
+        if data_ready.is_set():
+            return
+        started = time.perf_counter()
+        load_rooms()
+        memory_stats.rebuild(rooms)
+        load_users()
+        load_search_index()
+        load_read_state()
+        collect_upload_garbage(rebase=True)
+        startup_metrics['data_load'] = round(time.perf_counter() - started, 4)
+        data_ready.set()
+    # Только после load_users: в режиме 'lazy' до первого запроса users пуст
+    socketio.start_background_task(backfill_avatar_variants)
+    log.info("data loaded", extra={'rooms': len(rooms), 'users': len(users),
+                                   'seconds': startup_metrics['data_load']})
+
+def create_app(config=None):
+    """Настраивает приложение и загружает данные.
+
+    DATA_LOAD: 'eager' — загрузить сразу, 'lazy' — при первом запросе,
+    'background' — в фоне; пока данных нет, запросы получают 503.
+    Если create_app не вызывали (gunicorn main:app), ensure_data_ready
+    вызовет ее сама при первом запросе в режиме 'lazy'.
+    """
+    global _background_started
+    started = time.perf_counter()
+    if config:
+        app.config.update(config)
+    mode = app.config.setdefault('DATA_LOAD', 'eager')
+    if mode not in DATA_LOAD_MODES:
+        raise ValueError(f"Unknown DATA_LOAD mode: {mode}")
+    if app.config['MEDIA_OFFLOAD'] not in MEDIA_OFFLOAD_MODES:
+        raise ValueError(f"Unknown MEDIA_OFFLOAD mode: {app.config['MEDIA_OFFLOAD']}")
+
+    setup_logging()
+    for directory in (app.config['UPLOAD_ROOT'], app.config['AVATARS_ROOT'], app.config['THUMBNAILS_ROOT']):
+        os.makedirs(directory, exist_ok=True)
+    load_default_avatar()
+    fingerprint_static()
+    precompress_static()
+
+    if mode == 'eager':
+        load_data()
+    elif mode == 'background':
+        socketio.start_background_task(load_data)
+
+    if not _background_started:
+        socketio.start_background_task(ttl_sweeper, TTL_SWEEP_INTERVAL)
+        socketio.start_background_task(upload_gc_worker, UPLOAD_GC_INTERVAL)
+        socketio.start_background_task(read_state_flusher, READ_STATE_FLUSH_INTERVAL)
+        socketio.start_background_task(mailer.run)
+        for persister in persisters:
+            socketio.start_background_task(persister.run)
+        atexit.register(flush_persisters)
+        atexit.register(save_read_state)
+        _background_started = True
+
+    startup_metrics['create_app'] = round(time.perf_counter() - started, 4)
+    app_configured.set()
+    log.info("startup", extra={'startup': dict(startup_metrics), 'data_load_mode': mode})
+    return app
+
+@app.before_request
+def ensure_data_ready():
+    if data_ready.is_set() or request.endpoint == 'static':
+        return None
+    if not app_configured.is_set():
+        with _setup_lock:
+            if not app_configured.is_set():
+                create_app({'DATA_LOAD': app.config.get('DATA_LOAD', 'lazy')})
+    if app.config.get('DATA_LOAD') == 'lazy':
+        load_data()
+        return None
+    return render_template('error.html', error="Сервер запускается, попробуйте через несколько секунд"), 503, {'Retry-After': '5'}
+
+@app.get('/admin/disk-usage')
+@require_admin
+def admin_disk_usage():
+    return jsonify({
+        'total': disk_usage.total,
+        'global_quota': GLOBAL_DISK_QUOTA,
+        'room_quota': ROOM_DISK_QUOTA,
+        'rooms': dict(sorted(disk_usage.rooms.items(), key=lambda item: -item[1]))
+    })
+
+@app.get('/admin/mail')
+@require_admin
+def admin_mail():
+    return jsonify(mailer.status())
+
+@app.get('/admin/memory')
+@require_admin
+def admin_memory():
+    top = max(1, request.args.get('top', MEMORY_TOP_ROOMS, type=int))
+    user_avatar_bytes = sum(len(u.get('avatar') or '') for u in list(users.values()))
+    return jsonify({
+        'rss': process_rss(),
+        'rooms': memory_stats.report(top),
+        'users': {'count': len(users), 'avatar_base64_bytes': user_avatar_bytes},
+        'verification_codes': len(verification_codes),
+        'sessions': len(sessions),
+        'search_index_rooms': len(search_index.rooms),
+        'mail_queue': mailer.queue.qsize(),
+        'slow_log': len(slow_log),
+        'tracemalloc': tracemalloc.is_tracing()
+    })
+
+def take_filtered_snapshot():
+    """Снимок без кадров самого tracemalloc и importlib — одинаково для базы и для diff"""
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>')
+    ])
+
+@app.post('/admin/memory/tracemalloc')
+@require_admin
+def admin_tracemalloc():
+    """action=start|snapshot|diff|stop; diff сравнивает с последним snapshot"""
+    global tracemalloc_baseline
+    action = request.values.get('action', 'diff')
+    top = max(1, request.values.get('top', 25, type=int))
+    if action == 'start':
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        tracemalloc_baseline = take_filtered_snapshot()
+        return jsonify({'tracing': True})
+    if action == 'stop':
+        tracemalloc.stop()
+        tracemalloc_baseline = None
+        return jsonify({'tracing': False})
+    if not tracemalloc.is_tracing():
+        return jsonify({'error': 'tracemalloc is not running'}), 409
+
+    current = take_filtered_snapshot()
+    if action == 'snapshot':
+        tracemalloc_baseline = current
+        stats = current.statistics('lineno')[:top]
+        return jsonify({'top': [{'where': str(stat.traceback), 'size': stat.size, 'count': stat.count}
+                                for stat in stats]})
+    if action == 'diff':
+        if tracemalloc_baseline is None:
+            return jsonify({'error': 'No baseline snapshot'}), 409
+        stats = current.compare_to(tracemalloc_baseline, 'lineno')[:top]
+        return jsonify({'diff': [{'where': str(stat.traceback), 'size_diff': stat.size_diff,
+                                  'size': stat.size, 'count_diff': stat.count_diff}
+                                 for stat in stats]})
+    return jsonify({'error': 'Unknown action'}), 400
+
+@app.get('/admin/startup')
+@require_admin
+def admin_startup():
+    return jsonify({'ready': data_ready.is_set(), 'metrics': startup_metrics})
 
 # ----- Run -----
 if __name__ == "__main__":
-    socketio.run(app, debug=True)
\ No newline at end of file
+    socketio.run(create_app({'DATA_LOAD': os.environ.get('DATA_LOAD', 'eager')}),
+                 debug=os.environ.get('FLASK_DEBUG') == '1')
\ No newline at end of file
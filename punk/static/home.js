@@ -1,143 +1,157 @@
-class RoomSearch {
+class HomeManager {
     constructor() {
-        this.searchInput = document.getElementById('room-search');
-        this.resultsContainer = document.getElementById('search-results');
-        this.searchTimeout = null;
-        this.overlay = null;
+        this.searchOverlay = null;
         this.init();
     }
 
     init() {
-        if (this.searchInput) {
-            this.searchInput.addEventListener('input', this.handleSearch.bind(this));
-            this.searchInput.addEventListener('focus', this.handleFocus.bind(this));
-            
-            // Touch events for mobile
-            this.searchInput.addEventListener('touchstart', (e) => {
-                e.stopPropagation();
-            }, { passive: true });
+        this.setupEventListeners();
+        this.loadPublicRooms(); // Теперь этот метод существует
+        this.setupSearch();
+    }
+
+    setupEventListeners() {
+        // Форма присоединения
+        const joinForm = document.getElementById('join-form');
+        if (joinForm) {
+            joinForm.addEventListener('submit', (e) => this.handleJoin(e));
         }
 
-        // Close results when clicking outside (mobile only)
-        document.addEventListener('click', (e) => {
-            if (window.innerWidth <= 768) {
-                if (!this.searchInput?.contains(e.target) && 
-                    !this.resultsContainer?.contains(e.target) &&
-                    !this.overlay?.contains(e.target)) {
-                    this.hideResults();
-                }
-            }
-        });
+        // Форма создания
+        const createForm = document.getElementById('create-form');
+        if (createForm) {
+            createForm.addEventListener('submit', (e) => this.handleCreate(e));
+        }
 
-        document.addEventListener('touchstart', (e) => {
-            if (window.innerWidth <= 768) {
-                if (!this.searchInput?.contains(e.target) && 
-                    !this.resultsContainer?.contains(e.target) &&
-                    !this.overlay?.contains(e.target)) {
-                    this.hideResults();
-                }
-            }
-        }, { passive: true });
-    }
+        // Кнопка обновления комнат
+        const refreshBtn = document.getElementById('refresh-rooms');
+        if (refreshBtn) {
+            refreshBtn.addEventListener('click', () => this.loadPublicRooms());
+        }
 
-    handleSearch(e) {
-        const query = e.target.value.trim();
-        
-        // Clear previous timeout
-        if (this.searchTimeout) {
-            clearTimeout(this.searchTimeout);
+        // Закрытие модального окна
+        const closeModal = document.querySelector('.close-modal');
+        if (closeModal) {
+            closeModal.addEventListener('click', () => this.hideError());
         }
+    }
+
+    setupSearch() {
+        const searchInput = document.getElementById('room-search');
+        const resultsContainer = document.getElementById('search-results');
+        const desktopResultsContainer = document.getElementById('search-results-desktop');
         
-        // Debounce search to avoid too many requests
-        this.searchTimeout = setTimeout(() => {
-            if (query.length < 1) {
+        if (!searchInput) return;
+
+        let searchTimeout;
+
+        searchInput.addEventListener('input', (e) => {
+            clearTimeout(searchTimeout);
+            const query = e.target.value.trim();
+            
+            if (query.length < 2) {
                 this.hideResults();
                 return;
             }
-            this.searchRooms(query);
-        }, 300);
-    }
 
-    handleFocus() {
-        const query = this.searchInput.value.trim();
-        if (query.length >= 1) {
-            this.searchRooms(query);
-        }
+            searchTimeout = setTimeout(() => {
+                this.searchRooms(query);
+            }, 300);
+        });
+
+        // Закрытие результатов при клике вне (только для мобильных)
+        document.addEventListener('click', (e) => {
+            if (window.innerWidth <= 768) {
+                if (!searchInput.contains(e.target) && 
+                    !resultsContainer.contains(e.target) &&
+                    !this.searchOverlay?.contains(e.target)) {
+                    this.hideResults();
+                }
+            }
+        });
     }
 
     async searchRooms(query) {
         try {
             const response = await fetch(`/api/search-rooms?q=${encodeURIComponent(query)}`);
             const data = await response.json();
-            this.displayResults(data.rooms || []);
+            this.displaySearchResults(data.rooms || []);
         } catch (error) {
             console.error('Search error:', error);
         }
     }
 
-    displayResults(rooms) {
-    if (!this.resultsContainer) return;
-
-    if (rooms.length === 0) {
-        this.resultsContainer.innerHTML = `
-            <div class="search-result-item no-results">
-                <div style="text-align: center; color: #8899a6; padding: 20px;">
-                    Ничего не найдено
-                </div>
-            </div>
-        `;
-    } else {
-        this.resultsContainer.innerHTML = rooms.map(room => `
-            <div class="search-result-item" data-code="${room.code}">
-                <div class="search-result-content">
-                    <div class="search-result-title">${this.escapeHtml(room.title)}</div>
-                    <div class="search-result-meta">
-                        <span class="search-result-code">Код: ${room.code}</span>
-                        <span class="search-result-members">👥 ${room.members} онлайн</span>
+    displaySearchResults(rooms) {
+    const mobileContainer = document.getElementById('search-results');
+    const desktopContainer = document.getElementById('search-results-desktop');
+    
+    const renderResults = (container) => {
+        if (!container) return;
+        
+        if (rooms.length === 0) {
+            container.innerHTML = `
+                <div class="search-result-item no-results">
+                    <div style="text-align: center; color: #8899a6; padding: 20px;">
+                        Ничего не найдено
                     </div>
                 </div>
-                <div class="search-result-actions">
+            `;
+        } else {
+            container.innerHTML = rooms.map(room => `
+                <div class="search-result-item" data-code="${room.code}">
+                    <div class="search-result-content">
+                        <div class="search-result-title">${this.escapeHtml(room.title)}</div>
+                        <div class="search-result-meta">
+                            <span class="search-result-code">${room.code}</span>
+                            <span class="search-result-members">👥 ${room.members}</span>
+                        </div>
+                    </div>
                     <button class="join-search-result" data-code="${room.code}">
                         Присоединиться
                     </button>
                 </div>
-            </div>
-        `).join('');
+            `).join('');
 
-        // УБИРАЕМ обработчики для всей карточки, оставляем ТОЛЬКО для кнопки
-        this.resultsContainer.querySelectorAll('.join-search-result').forEach(joinButton => {
-            const roomCode = joinButton.dataset.code;
-            
-            // Click on join button
-            joinButton.addEventListener('click', (e) => {
-                e.stopPropagation();
-                e.preventDefault();
-                this.selectRoom(roomCode);
+            // УБИРАЕМ обработчики для всей карточки, оставляем ТОЛЬКО для кнопки
+            container.querySelectorAll('.join-search-result').forEach(joinButton => {
+                const roomCode = joinButton.dataset.code;
+                
+                // Клик по кнопке присоединения
+                joinButton.addEventListener('click', (e) => {
+                    e.stopPropagation(); // Останавливаем всплытие
+                    e.preventDefault(); // Предотвращаем действия по умолчанию
+                    this.selectRoom(roomCode);
+                });
+                
+                // Касания для мобильных
+                joinButton.addEventListener('touchstart', (e) => {
+                    e.stopPropagation();
+                    e.preventDefault();
+                    this.selectRoom(roomCode);
+                }, { passive: false });
             });
-            
-            // Touch events
-            joinButton.addEventListener('touchstart', (e) => {
-                e.stopPropagation();
-                e.preventDefault();
-                this.selectRoom(roomCode);
-            }, { passive: false });
-        });
-    }
+        }
+
+        container.style.display = 'block';
+        container.classList.add('active');
+    };
 
-    this.resultsContainer.style.display = 'block';
-    this.resultsContainer.classList.add('active');
+    // Рендерим в оба контейнера
+    renderResults(mobileContainer);
+    renderResults(desktopContainer);
     
-    // Add overlay for mobile
+    // Добавляем overlay только для мобильных
     if (window.innerWidth <= 768) {
-        this.addOverlay();
+        this.addSearchOverlay();
     }
 }
-    addOverlay() {
-        this.removeOverlay();
+
+    addSearchOverlay() {
+        this.removeSearchOverlay();
         
-        this.overlay = document.createElement('div');
-        this.overlay.className = 'search-overlay';
-        this.overlay.style.cssText = `
+        this.searchOverlay = document.createElement('div');
+        this.searchOverlay.className = 'search-overlay';
+        this.searchOverlay.style.cssText = `
             position: fixed;
             top: 0;
             left: 0;
@@ -147,34 +161,39 @@ class RoomSearch {
             z-index: 9999;
             cursor: pointer;
         `;
-        document.body.appendChild(this.overlay);
         
-        this.overlay.addEventListener('click', () => {
+        document.body.appendChild(this.searchOverlay);
+        
+        // Закрываем результаты при клике на overlay
+        this.searchOverlay.addEventListener('click', () => {
             this.hideResults();
         });
         
-        this.overlay.addEventListener('touchstart', (e) => {
+        this.searchOverlay.addEventListener('touchstart', (e) => {
             e.preventDefault();
             this.hideResults();
         }, { passive: false });
     }
 
-    removeOverlay() {
-        if (this.overlay) {
-            this.overlay.remove();
-            this.overlay = null;
+    removeSearchOverlay() {
+        if (this.searchOverlay) {
+            this.searchOverlay.remove();
+            this.searchOverlay = null;
         }
     }
 
     selectRoom(roomCode) {
         console.log('Selected room:', roomCode);
         
+        // Сначала проверяем, существует ли комната
         fetch(`/api/check-room?code=${encodeURIComponent(roomCode)}`)
             .then(response => response.json())
             .then(data => {
                 if (data.exists) {
+                    // Комната существует - входим в нее
                     window.location.href = `/room?room=${roomCode}`;
                 } else {
+                    // Комната не существует - показываем ошибку
                     this.showError('Комната не найдена или была удалена');
                     this.hideResults();
                 }
@@ -185,7 +204,28 @@ class RoomSearch {
             });
         
         this.hideResults();
-        this.searchInput.value = '';
+        // Очищаем поле поиска
+        const searchInput = document.getElementById('room-search');
+        if (searchInput) {
+            searchInput.value = '';
+        }
+    }
+
+    hideResults() {
+        const mobileContainer = document.getElementById('search-results');
+        const desktopContainer = document.getElementById('search-results-desktop');
+        
+        if (mobileContainer) {
+            mobileContainer.style.display = 'none';
+            mobileContainer.classList.remove('active');
+        }
+        
+        if (desktopContainer) {
+            desktopContainer.style.display = 'none';
+            desktopContainer.classList.remove('active');
+        }
+        
+        this.removeSearchOverlay();
     }
 
     showError(message) {
@@ -212,24 +252,25 @@ class RoomSearch {
         }, 3000);
     }
 
-    hideResults() {
-        if (this.resultsContainer) {
-            this.resultsContainer.style.display = 'none';
-            this.resultsContainer.classList.remove('active');
-        }
-        this.removeOverlay();
-    }
+    // ДОБАВЛЯЕМ НЕДОСТАЮЩИЙ МЕТОД loadPublicRooms
+    async loadPublicRooms() {
+        const container = document.getElementById('public-rooms');
+        if (!container) return;
 
-    escapeHtml(text) {
-        if (!text) return '';
-        const div = document.createElement('div');
-        div.textContent = text;
-        return div.innerHTML;
+        container.innerHTML = '<div class="loading-state">Загрузка комнат...</div>';
+
+        try {
+            const response = await fetch('/api/public-rooms');
+            const data = await response.json();
+            this.renderPublicRooms(data.rooms || []);
+        } catch (error) {
+            console.error('Error loading public rooms:', error);
+            container.innerHTML = '<div class="error-state">Ошибка загрузки комнат</div>';
+        }
     }
-}
 
-// Public rooms functionality
-function renderPublicRooms(rooms) {
+    // ДОБАВЛЯЕМ НЕДОСТАЮЩИЙ МЕТОД renderPublicRooms
+    renderPublicRooms(rooms) {
     const container = document.getElementById('public-rooms');
     if (!container) return;
 
@@ -237,65 +278,120 @@ function renderPublicRooms(rooms) {
         container.innerHTML = '<div class="empty-state">Публичных комнат пока нет. Будьте первым!</div>';
         return;
     }
-    
-    container.innerHTML = '';
-    rooms.forEach(r => {
-        const item = document.createElement('div');
-        item.className = 'room-item';
-        item.innerHTML = `
+
+    container.innerHTML = rooms.map(room => `
+        <div class="room-item">
             <div class="room-content">
-                <div class="room-title"><strong>${r.title}</strong></div>
+                <h4 class="room-title">${this.escapeHtml(room.title)}</h4>
                 <div class="room-meta">
-                    <span class="room-code">Код: ${r.code}</span>
-                    <span class="room-members">👥 ${r.members} онлайн</span>
+                    <span class="room-code">${room.code}</span>
+                    <span class="room-members">👥 ${room.members}</span>
                 </div>
             </div>
-            <button type="button" class="join-public" data-code="${r.code}">
+            <button class="join-room-btn" data-code="${room.code}">
                 Присоединиться
             </button>
-        `;
+        </div>
+    `).join('');
+
+    // Обработчики ТОЛЬКО для кнопок присоединения
+    container.querySelectorAll('.join-room-btn').forEach(btn => {
+        btn.addEventListener('click', () => {
+            this.selectRoom(btn.dataset.code);
+        });
         
-        const button = item.querySelector('button.join-public');
-        button.addEventListener('click', () => this.joinPublicRoom(r.code));
-        button.addEventListener('touchstart', (e) => {
+        // Для мобильных
+        btn.addEventListener('touchstart', (e) => {
             e.preventDefault();
-            this.joinPublicRoom(r.code);
+            this.selectRoom(btn.dataset.code);
         }, { passive: false });
-        
-        container.appendChild(item);
     });
 }
 
-function joinPublicRoom(code) {
-    const codeInput = document.getElementById('code');
-    if (codeInput) {
-        codeInput.value = code;
-        const joinButton = document.getElementById('join-button');
-        if (joinButton) {
-            joinButton.click();
+    // ДОБАВЛЯЕМ НЕДОСТАЮЩИЙ МЕТОД handleJoin
+    async handleJoin(e) {
+        e.preventDefault();
+        const formData = new FormData(e.target);
+        const code = formData.get('code').trim();
+
+        if (!code) {
+            this.showError('Введите код комнаты');
+            return;
         }
-    }
-}
 
-async function fetchPublicRooms() {
-    try {
-        const res = await fetch('/api/public-rooms');
-        const data = await res.json();
-        renderPublicRooms(data.rooms || []);
-    } catch (e) {
-        console.log('[PublicRooms] fetch error', e);
+        // Проверяем существование комнаты
+        try {
+            const response = await fetch(`/api/check-room?code=${encodeURIComponent(code)}`);
+            const data = await response.json();
+
+            if (data.exists) {
+                // Перенаправляем в комнату
+                window.location.href = `/room?room=${code}`;
+            } else {
+                this.showError('Комната не найдена. Проверьте код или создайте новую комнату.');
+            }
+        } catch (error) {
+            this.showError('Ошибка при проверке комнаты');
+        }
     }
-}
 
+    // ДОБАВЛЯЕМ НЕДОСТАЮЩИЙ МЕТОД handleCreate
+    async handleCreate(e) {
+        e.preventDefault();
+        const formData = new FormData(e.target);
+        const title = formData.get('title').trim();
+        const isPublic = formData.get('is_public') === 'on';
+
+        // Отправляем запрос на создание комнаты
+        try {
+            const response = await fetch('/', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/x-www-form-urlencoded',
+                },
+                body: new URLSearchParams({
+                    'create': 'create',
+                    'title': title,
+                    'is_public': isPublic
+                })
+            });
+
+            if (response.ok) {
+                // Перенаправляем в созданную комнату
+                window.location.href = '/room';
+            } else {
+                this.showError('Ошибка при создании комнаты');
+            }
+        } catch (error) {
+            this.showError('Ошибка при создании комнаты');
+        }
+    }
 
+    // ДОБАВЛЯЕМ НЕДОСТАЮЩИЙ МЕТОД hideError
+    hideError() {
+        const modal = document.getElementById('error-modal');
+        if (modal) {
+            modal.classList.add('hidden');
+        }
+    }
 
+    // ДОБАВЛЯЕМ НЕДОСТАЮЩИЙ МЕТОД escapeHtml
+    escapeHtml(text) {
+        if (!text) return '';
+        const div = document.createElement('div');
+        div.textContent = text;
+        return div.innerHTML;
+    }
+}
 
-// Initialize when DOM is loaded
+// Инициализация при загрузке
 document.addEventListener('DOMContentLoaded', function() {
-    // Initialize search
-    window.roomSearch = new RoomSearch();
+    window.homeManager = new HomeManager();
     
-    // Load and refresh public rooms
-    fetchPublicRooms();
-    setInterval(fetchPublicRooms, 10000); // Update every 10 seconds
-});
\ No newline at end of file
+    // Авто-обновление списка комнат каждые 30 секунд
+    setInterval(() => {
+        if (window.homeManager && window.homeManager.loadPublicRooms) {
+            window.homeManager.loadPublicRooms();
+        }
+    }, 30000);
+});
@@ -51,7 +51,7 @@ class Notifications {
         container.innerHTML = this.notifications.map(notif => `
             <div class="notification-item" data-user-id="${notif.from_user_id}">
                 <div class="notification-avatar">
-                    <img src="/api/user/${notif.from_user_id}/avatar" class="avatar" onerror="this.src='data:image/png;base64,' + defaultAvatar">
+                    <img src="/api/user/${notif.from_user_id}/avatar?size=96" class="avatar" onerror="this.src='data:image/png;base64,' + defaultAvatar">
                 </div>
                 <div class="notification-content">
                     <div class="notification-text">
@@ -97,7 +97,7 @@ class Notifications {
 
         container.innerHTML = this.recentChats.map(chat => `
             <div class="chat-item" data-user-id="${chat.user_id}">
-                <img src="data:image/png;base64,${chat.avatar}" class="avatar" onerror="this.src='data:image/png;base64,' + defaultAvatar">
+                <img src="${chat.avatar_url}" class="avatar" onerror="this.src='data:image/png;base64,' + defaultAvatar">
                 <div class="chat-info">
                     <div class="chat-name">${this.escapeHtml(chat.display_name)}</div>
                     <div class="chat-preview">${this.escapeHtml(chat.last_message)}</div>
@@ -3,7 +3,14 @@ class RoomChat {
     constructor(config) {
         console.log('RoomChat initializing with config:', config);
         
-        this.socket = io();
+        // Последний полученный seq: при (пере)подключении сервер досылает только пропущенное.
+        // Дубли отсекаются по множеству уже показанных seq, а не по lastSeq: сообщение
+        // с меньшим seq может прийти позже большего
+        const initialSeqs = (Array.isArray(config.initialMessages) ? config.initialMessages : [])
+            .map(msg => msg.seq).filter(Boolean);
+        this.seenSeqs = new Set(initialSeqs);
+        this.lastSeq = initialSeqs.reduce((max, seq) => Math.max(max, seq), 0);
+        this.socket = io({ auth: (cb) => cb({ last_seq: this.lastSeq }) });
         
         // DOM elements
         this.messagesDiv = document.getElementById('messages');
@@ -36,6 +43,10 @@ class RoomChat {
         this.userId = config.userId || '';
         this.userName = config.userName || '';
         this.userAvatar = config.userAvatar || '';
+        // user_id -> avatar_version; неизвестных авторов добираем пачкой через /api/users
+        this.avatarVersions = new Map(Object.entries(config.avatarVersions || {}));
+        this.pendingAvatarIds = new Set();
+        this.avatarSize = window.devicePixelRatio > 1 ? 96 : 48;
         
         // State
         this.cooldownTime = 1000;
@@ -325,9 +336,21 @@ class RoomChat {
     
     this.socket.on('message', (msg) => {
         console.log('[Debug] Received message:', msg);
-        this.addMessage(msg);
+        this.addSequencedMessage(msg);
+    });
+
+    this.socket.on('resume', (data) => {
+        if (data.too_far_behind) {
+            window.location.reload();
+            return;
+        }
+        (data.messages || []).forEach(msg => this.addSequencedMessage(msg));
     });
     
+    this.socket.on('file_meta', (data) => {
+        this.handleFileMeta(data);
+    });
+
     this.socket.on('message_deleted', (data) => {
         console.log('[Debug] Message deleted:', data);
         this.handleMessageDeleted(data);
@@ -348,6 +371,15 @@ class RoomChat {
     });
 }
 
+addSequencedMessage(msg) {
+    if (msg.seq) {
+        if (this.seenSeqs.has(msg.seq)) return;
+        this.seenSeqs.add(msg.seq);
+        this.lastSeq = Math.max(this.lastSeq, msg.seq);
+    }
+    this.addMessage(msg);
+}
+
 handleMessageEdited(data) {
     // Находим элемент сообщения по ID
     const messageElement = this.messagesDiv.querySelector(`[data-message-id="${data.message_id}"]`);
@@ -695,7 +727,13 @@ handleMessageEdited(data) {
     msgElem.dataset.messageId = msg.id || msg.timestamp; // Уникальный ID сообщения
 
 
-    const avatar = msg.avatar ? `data:image/png;base64,${msg.avatar}` : `data:image/png;base64,${this.defaultAvatar}`;
+    const defaultAvatarSrc = `data:image/png;base64,${this.defaultAvatar}`;
+    if (msg.user_id && msg.avatar_version !== undefined) {
+        this.avatarVersions.set(msg.user_id, msg.avatar_version);
+    }
+    const avatar = msg.user_id
+        ? this.avatarSrc(msg.user_id)
+        : (msg.avatar ? `data:image/png;base64,${msg.avatar}` : defaultAvatarSrc);
 
     const left = document.createElement('div');
     left.className = 'avatar-container';
@@ -703,6 +741,12 @@ handleMessageEdited(data) {
     
     const avatarImg = document.createElement('img');
     avatarImg.className = 'avatar clickable-avatar';
+    avatarImg.loading = 'lazy';
+    if (msg.user_id) avatarImg.dataset.avatarUser = msg.user_id;
+    avatarImg.onerror = () => {
+        avatarImg.onerror = null;
+        avatarImg.src = defaultAvatarSrc;
+    };
     avatarImg.src = avatar;
     
     // Add context menu handlers
@@ -770,14 +814,48 @@ handleMessageEdited(data) {
     
 }
 
+avatarSrc(userId) {
+    // Размер под CSS (44px) с учетом плотности экрана; с v= ответ кэшируется навсегда
+    let url = `/api/user/${encodeURIComponent(userId)}/avatar?size=${this.avatarSize}`;
+    if (this.avatarVersions.has(userId)) {
+        const version = this.avatarVersions.get(userId);
+        return version ? `${url}&v=${encodeURIComponent(version)}` : url;
+    }
+    this.requestAvatarVersion(userId);
+    return url;
+}
+
+requestAvatarVersion(userId) {
+    if (this.pendingAvatarIds.has(userId)) return;
+    this.pendingAvatarIds.add(userId);
+    clearTimeout(this.avatarLookupTimer);
+    this.avatarLookupTimer = setTimeout(() => {
+        const ids = [...this.pendingAvatarIds];
+        this.pendingAvatarIds.clear();
+        fetch(`/api/users?ids=${ids.map(encodeURIComponent).join(',')}`)
+            .then(response => response.ok ? response.json() : { users: {} })
+            .then(data => {
+                Object.entries(data.users || {}).forEach(([id, info]) => {
+                    this.avatarVersions.set(id, info.avatar_version || null);
+                    if (!info.avatar_version) return;
+                    this.messagesDiv.querySelectorAll('img[data-avatar-user]').forEach(img => {
+                        if (img.dataset.avatarUser === id) img.src = this.avatarSrc(id);
+                    });
+                });
+            })
+            .catch(e => console.warn('Avatar lookup failed:', e));
+    }, 50);
+}
+
 createAudioPlayer(file) {
+    const duration = file.duration ? this.formatTime(file.duration) : '0:00';
     return `
-        <div class="audio-container">
+        <div class="audio-container" data-file-name="${file.name}">
             <div class="audio-header">
                 <div class="audio-icon">🎵</div>
                 <div class="audio-info">
                     <div class="audio-title">Аудио сообщение</div>
-                    <div class="audio-duration">0:00</div>
+                    <div class="audio-duration">${duration}</div>
                 </div>
             </div>
             <div class="audio-controls">
@@ -786,7 +864,7 @@ createAudioPlayer(file) {
                     <div class="progress-bar"></div>
                 </div>
                 <div class="time-display">
-                    <span class="current-time">0:00</span> / <span class="duration">0:00</span>
+                    <span class="current-time">0:00</span> / <span class="duration">${duration}</span>
                 </div>
                 <div class="volume-control">
                     <span class="volume-icon">🔊</span>
@@ -795,6 +873,19 @@ createAudioPlayer(file) {
                     </div>
                 </div>
             </div>
+            ${this.createAudioWaves(file)}
+            <audio class="audio-preview" preload="metadata" controlsList="nodownload">
+                <source src="${file.url}" type="${file.type}">
+                Ваш браузер не поддерживает аудио элементы.
+            </audio>
+        </div>
+    `;
+}
+
+createAudioWaves(file) {
+    // Пики приходят с сервера парами [min, max] в процентах — аудио для этого не качаем
+    if (!file.peaks || !file.peaks.length) {
+        return `
             <div class="audio-waves">
                 <div class="wave"></div>
                 <div class="wave"></div>
@@ -802,12 +893,29 @@ createAudioPlayer(file) {
                 <div class="wave"></div>
                 <div class="wave"></div>
             </div>
-            <audio class="audio-preview" preload="metadata" controlsList="nodownload">
-                <source src="${file.url}" type="${file.type}">
-                Ваш браузер не поддерживает аудио элементы.
-            </audio>
-        </div>
-    `;
+        `;
+    }
+    let bars = '';
+    for (let i = 0; i + 1 < file.peaks.length; i += 2) {
+        const height = Math.max(4, Math.abs(file.peaks[i]), Math.abs(file.peaks[i + 1]));
+        bars += `<div class="peak" style="height:${height}%"></div>`;
+    }
+    return `<div class="audio-waves audio-peaks">${bars}</div>`;
+}
+
+handleFileMeta(data) {
+    const file = data.file;
+    if (!file || !file.name) return;
+    this.messagesDiv.querySelectorAll('.audio-container').forEach(container => {
+        if (container.dataset.fileName !== file.name) return;
+        const waves = container.querySelector('.audio-waves');
+        if (waves && file.peaks) waves.outerHTML = this.createAudioWaves(file);
+        if (file.duration) {
+            container.querySelectorAll('.audio-duration, .duration').forEach(el => {
+                el.textContent = this.formatTime(file.duration);
+            });
+        }
+    });
 }
 
 createVideoPlayer(file) {
@@ -831,13 +939,79 @@ createVideoPlayer(file) {
 }
 
 createImagePreview(file) {
+    // Размеры и плейсхолдер считает сервер при загрузке: место под картинку резервируется сразу
+    const size = file.width && file.height ? `width="${file.width}" height="${file.height}"` : '';
+    const placeholder = file.placeholder ? this.decodeBlurhash(file.placeholder) : null;
+    const style = placeholder ? `style="background-image:url(${placeholder})"` : '';
+    const onload = placeholder ? `onload="this.classList.add('loaded')"` : '';
     return `
-        <div class="image-container">
-            <img src="${file.url}" alt="Изображение" class="media-preview image-preview" loading="lazy">
+        <div class="image-container ${file.orientation || ''}">
+            <img src="${file.url}" alt="Изображение" class="media-preview image-preview${placeholder ? ' blurred' : ''}" loading="lazy" ${size} ${style} ${onload}>
         </div>
     `;
 }
 
+decodeBlurhash(hash, width = 32, height = 32) {
+    this.blurhashCache = this.blurhashCache || new Map();
+    if (this.blurhashCache.has(hash)) return this.blurhashCache.get(hash);
+
+    const alphabet = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~';
+    const decode83 = (str) => [...str].reduce((value, ch) => value * 83 + alphabet.indexOf(ch), 0);
+    const toLinear = (c) => { const v = c / 255; return v <= 0.04045 ? v / 12.92 : Math.pow((v + 0.055) / 1.055, 2.4); };
+    const toSrgb = (v) => { v = Math.max(0, Math.min(1, v)); return Math.round(v <= 0.0031308 ? v * 12.92 * 255 : (1.055 * Math.pow(v, 1 / 2.4) - 0.055) * 255); };
+    const signPow = (v, e) => Math.sign(v) * Math.pow(Math.abs(v), e);
+
+    let url = null;
+    try {
+        const sizeFlag = decode83(hash[0]);
+        const cx = sizeFlag % 9 + 1, cy = Math.floor(sizeFlag / 9) + 1;
+        if (hash.length !== 4 + 2 * cx * cy) throw new Error('bad blurhash');
+        const maxValue = (decode83(hash[1]) + 1) / 166;
+        const colors = [];
+        const dc = decode83(hash.substring(2, 6));
+        colors.push([toLinear(dc >> 16), toLinear((dc >> 8) & 255), toLinear(dc & 255)]);
+        for (let i = 1; i < cx * cy; i++) {
+            const ac = decode83(hash.substring(4 + i * 2, 6 + i * 2));
+            colors.push([
+                signPow((Math.floor(ac / 361) - 9) / 9, 2) * maxValue,
+                signPow((Math.floor(ac / 19) % 19 - 9) / 9, 2) * maxValue,
+                signPow((ac % 19 - 9) / 9, 2) * maxValue
+            ]);
+        }
+
+        const canvas = document.createElement('canvas');
+        canvas.width = width;
+        canvas.height = height;
+        const ctx = canvas.getContext('2d');
+        const image = ctx.createImageData(width, height);
+        for (let y = 0; y < height; y++) {
+            for (let x = 0; x < width; x++) {
+                let r = 0, g = 0, b = 0;
+                for (let j = 0; j < cy; j++) {
+                    for (let i = 0; i < cx; i++) {
+                        const basis = Math.cos(Math.PI * x * i / width) * Math.cos(Math.PI * y * j / height);
+                        const color = colors[i + j * cx];
+                        r += color[0] * basis;
+                        g += color[1] * basis;
+                        b += color[2] * basis;
+                    }
+                }
+                const offset = 4 * (x + y * width);
+                image.data[offset] = toSrgb(r);
+                image.data[offset + 1] = toSrgb(g);
+                image.data[offset + 2] = toSrgb(b);
+                image.data[offset + 3] = 255;
+            }
+        }
+        ctx.putImageData(image, 0, 0);
+        url = canvas.toDataURL();
+    } catch (e) {
+        console.warn('Blurhash decode failed:', e);
+    }
+    this.blurhashCache.set(hash, url);
+    return url;
+}
+
 createFilePreview(file) {
     return `
         <div class="file-container">
@@ -2204,6 +2378,7 @@ document.addEventListener('DOMContentLoaded', function() {
         let userId = '';
         let userName = '';
         let userAvatar = '';
+        let avatarVersions = {};
         
         try {
             const messagesJson = messagesJsonElement.textContent.trim();
@@ -2219,6 +2394,11 @@ document.addEventListener('DOMContentLoaded', function() {
             userId = roomData.dataset.userId || '';
             userName = roomData.dataset.userName || '';
             userAvatar = roomData.dataset.userAvatar || '';
+            try {
+                avatarVersions = JSON.parse(roomData.dataset.avatarVersions || '{}');
+            } catch (e) {
+                console.error('Error parsing avatar versions:', e);
+            }
         }
         
         const config = {
@@ -2226,7 +2406,8 @@ document.addEventListener('DOMContentLoaded', function() {
             defaultAvatar: defaultAvatar,
             userId: userId,
             userName: userName,
-            userAvatar: userAvatar
+            userAvatar: userAvatar,
+            avatarVersions: avatarVersions
         };
         
         try {
@@ -0,0 +1,82 @@
+// Мобильные обработчики для room.js
+document.addEventListener('DOMContentLoaded', function() {
+    // Инициализация мобильного интерфейса
+    initMobileInterface();
+});
+
+function initMobileInterface() {
+    // Обработчик мобильного меню
+    const menuBtn = document.getElementById('mobile-menu-btn');
+    const mobileNav = document.getElementById('mobile-nav');
+    
+    if (menuBtn && mobileNav) {
+        menuBtn.addEventListener('click', () => {
+            mobileNav.classList.remove('hidden');
+        });
+        
+        // Закрытие меню
+        mobileNav.addEventListener('click', (e) => {
+            if (e.target.classList.contains('mobile-nav-close') || 
+                e.target.classList.contains('mobile-nav')) {
+                mobileNav.classList.add('hidden');
+            }
+        });
+    }
+    
+    // Кнопка прокрутки вниз
+    const scrollDownBtn = document.getElementById('mobile-scroll-down');
+    if (scrollDownBtn) {
+        scrollDownBtn.addEventListener('click', () => {
+            window.roomChat?.scrollToBottom();
+        });
+    }
+    
+    // Улучшенное контекстное меню для мобильных
+    setupMobileContextMenu();
+    
+    // Оптимизация касаний
+    setupTouchOptimizations();
+}
+
+function setupMobileContextMenu() {
+    const contextMenu = document.getElementById('mobile-context-menu');
+    
+    // Долгое нажатие на сообщение
+    document.addEventListener('touchstart', function(e) {
+        const message = e.target.closest('.message');
+        if (message && window.roomChat) {
+            window.roomChat.handleMessageTouchStart(e);
+        }
+    });
+    
+    document.addEventListener('touchend', function(e) {
+        window.roomChat?.handleMessageTouchEnd(e);
+    });
+}
+
+function setupTouchOptimizations() {
+    // Предотвращение двойного тапа для зума
+    let lastTouchEnd = 0;
+    document.addEventListener('touchend', function(event) {
+        const now = (new Date()).getTime();
+        if (now - lastTouchEnd <= 300) {
+            event.preventDefault();
+        }
+        lastTouchEnd = now;
+    }, false);
+    
+    // Улучшенная обработка касаний для кнопок
+    document.addEventListener('touchstart', function(e) {
+        if (e.target.classList.contains('toolbar-button') || 
+            e.target.classList.contains('mobile-action-btn')) {
+            e.target.style.transform = 'scale(0.95)';
+        }
+    });
+    
+    document.addEventListener('touchend', function(e) {
+        if (e.target.classList.contains('toolbar-button') || 
+            e.target.classList.contains('mobile-action-btn')) {
+            e.target.style.transform = 'scale(1)';
+        }
+    });
+}
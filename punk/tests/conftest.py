@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    paths = {key: str(tmp_path / key.lower()) for key in ('UPLOAD_ROOT', 'AVATARS_ROOT', 'THUMBNAILS_ROOT')}
+    paths.update({key: str(tmp_path / f"{key.lower()}.json")
+                  for key in ('STORAGE_FILE', 'USERS_FILE', 'SEARCH_INDEX_FILE', 'READ_STATE_FILE')})
+    main.create_app({'TESTING': True, 'DATA_LOAD': 'eager', **paths})
+    monkeypatch.setitem(main.app.config, 'MEDIA_OFFLOAD', '')
+    yield main.app
+    main.rooms.clear()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
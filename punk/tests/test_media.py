@@ -0,0 +1,57 @@
+import os
+
+import main
+
+
+def add_upload(app, room='ROOM', name='clip.txt', data=b'hello'):
+    main.rooms[room] = {'members': 0, 'messages': []}
+    room_dir = os.path.join(app.config['UPLOAD_ROOT'], room)
+    os.makedirs(room_dir, exist_ok=True)
+    path = os.path.join(room_dir, name)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def test_nginx_offload_sets_accel_redirect(app, client):
+    add_upload(app)
+    app.config['MEDIA_OFFLOAD'] = 'nginx'
+    response = client.get('/media/ROOM/clip.txt')
+    assert response.status_code == 200
+    assert response.headers['X-Accel-Redirect'] == '/_protected/uploads/ROOM/clip.txt'
+    assert 'X-Sendfile' not in response.headers
+    assert response.data == b''
+
+
+def test_sendfile_offload_sets_realpath(app, client):
+    path = add_upload(app)
+    app.config['MEDIA_OFFLOAD'] = 'sendfile'
+    response = client.get('/media/ROOM/clip.txt')
+    assert response.status_code == 200
+    assert response.headers['X-Sendfile'] == os.path.realpath(path)
+    assert 'X-Accel-Redirect' not in response.headers
+    assert response.data == b''
+
+
+def test_direct_serving_without_offload(app, client):
+    add_upload(app)
+    response = client.get('/media/ROOM/clip.txt')
+    assert response.status_code == 200
+    assert response.data == b'hello'
+    assert 'X-Accel-Redirect' not in response.headers
+
+
+def test_path_traversal_is_rejected(app, client):
+    add_upload(app)
+    add_upload(app, room='OTHER', name='secret.txt')
+    for mode in ('', 'nginx', 'sendfile'):
+        app.config['MEDIA_OFFLOAD'] = mode
+        assert client.get('/media/ROOM/%2e%2e/OTHER/secret.txt').status_code == 404
+        assert client.get('/media/ROOM/..%2fOTHER%2fsecret.txt').status_code == 404
+
+
+def test_unknown_room_is_not_found(app, client):
+    add_upload(app)
+    for mode in ('', 'nginx', 'sendfile'):
+        app.config['MEDIA_OFFLOAD'] = mode
+        assert client.get('/media/NOPE/clip.txt').status_code == 404